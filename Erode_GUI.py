@@ -10,22 +10,44 @@ from tkinter import ttk
 from erode_bag_functions import process_bag
 from erode_csar_functions import erode_outer_edge  # Import the CSAR erosion function
 from erode_geotiff_functions import process_geotiff  # Import the GeoTIFF erosion function
+from erode_events import CancelToken, ErosionCancelled, EventLog, emit
 import os
+import queue
 import time
 import threading
+import traceback
 import sys
 
+# Milliseconds between two looks at the event queue
+POLL_INTERVAL_MS = 100
 
-class CustomStream:
-    def __init__(self, text_widget):
-        self.text_widget = text_widget
+
+class QueueStream:
+    # Stands in for sys.stdout: text printed on any thread is queued for the
+    # message box (and still goes to the console, if there is one)
+    def __init__(self, events, stream=None):
+        self.events = events
+        self.stream = stream
 
     def write(self, message):
-        self.text_widget.insert(tk.END, message)
-        self.text_widget.yview(tk.END)
+        if message:
+            self.events.put(dict(event="output", text=message))
+        if self.stream is not None:
+            self.stream.write(message)
 
     def flush(self):
-        pass
+        if self.stream is not None:
+            self.stream.flush()
+
+
+class QueueProgress:
+    # Stands in for the progress bar in code that sets progress["value"]
+    # itself (the CSAR erosion): the value is queued as a progress event
+    def __init__(self, events):
+        self.events = events
+
+    def __setitem__(self, key, value):
+        emit(self.events.put, "progress", percent=value)
 
 
 class App:
@@ -36,10 +58,20 @@ class App:
         self.input_file_var = tk.StringVar()
         self.output_dir_var = tk.StringVar()
         self.file_format_var = tk.StringVar(value="CSAR")  # Default value
+        self.profile_var = tk.BooleanVar(value=False)
+        self.event_log = None
         #self.file_format_var = tk.StringVar(value="GeoTiff")  # Default value changed to GeoTIFF
 
+        # The processing thread never touches the widgets: it queues events,
+        # and the Tk loop applies them in poll_events
+        self.events = queue.Queue()
+        self.cancel_token = None
+        self.worker = None
+        self.closing = False
 
         self.create_widgets()
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
+        self.poll_events()
 
     def browse_input_file(self):
         file_format = self.file_format_var.get()
@@ -58,13 +90,6 @@ class App:
         self.output_dir_var.set(output_dir)
 
     def process(self):
-        self.progress["value"] = 0
-        threading.Thread(target=self._process, daemon=True).start()
-
-    def _process(self):
-        start_time = time.time()
-        self.add_message('***commencing erosion process***')
-
         file_format = self.file_format_var.get()
         input_file = self.input_file_var.get()
         output_dir = self.output_dir_var.get()
@@ -73,31 +98,111 @@ class App:
             self.add_message("Please select an input file and output directory.")
             return
 
-        original_stdout = sys.stdout
-        sys.stdout = CustomStream(self.message_text)
+        # The engine's events drive the progress bar and the chunk messages;
+        # with Profile ticked a trace is written next to the output
+        trace_path = None
+        if self.profile_var.get():
+            trace_path = os.path.join(output_dir, os.path.splitext(os.path.basename(input_file))[0] + ".trace.json")
+        self.event_log = EventLog(trace_path, console=False)
+
+        self.progress["value"] = 0
+        self.status_label['text'] = ""
+        self.cancel_token = CancelToken()
+        self.process_button["state"] = "disabled"
+        self.cancel_button["state"] = "normal" if file_format != "CSAR" else "disabled"
+        self.worker = threading.Thread(target=self._process, args=(file_format, input_file, output_dir), daemon=True)
+        self.worker.start()
+
+    def _process(self, file_format, input_file, output_dir):
+        # Runs on the processing thread: everything it reports goes through the queue
+        start_time = time.time()
+        self.post("message", text='***commencing erosion process***')
 
         try:
             if file_format == "BAG":
-                process_bag(input_file, output_dir, self.progress, self.root)
+                process_bag(input_file, output_dir, None, None, on_event=self.on_event, cancel=self.cancel_token)
             elif file_format == "GeoTiff":
-                process_geotiff(input_file, output_dir, self.progress, self.root)
+                process_geotiff(input_file, output_dir, None, None, on_event=self.on_event, cancel=self.cancel_token)
             elif file_format == "CSAR":
                 root, ext = os.path.splitext(os.path.basename(input_file))
                 eroded_csar = os.path.join(output_dir, f"{root}_eroded.csar")
-                erode_outer_edge(input_file, eroded_csar, progress=self.progress)
-
-        finally:
-            sys.stdout = original_stdout
-
-        self.status_label['text'] = "Processing completed successfully. Have a Happy Hydro Day!"
-        self.add_message("***Processing completed successfully. Have a Happy Hydro Day!***")
+                erode_outer_edge(input_file, eroded_csar, progress=QueueProgress(self.events))
+        except ErosionCancelled:
+            self.post("finished", status="Processing cancelled; the partial output was removed.")
+            return
+        except Exception:
+            self.post("message", text=traceback.format_exc())
+            self.post("finished", status="Processing failed, see the messages below.")
+            return
 
         end_time = time.time()
         execution_time = end_time - start_time
-        self.add_message(f"The function took {execution_time:.2f} seconds to run.")
-        os.startfile(output_dir)
-
-        self.progress["value"] = 100
+        self.post("finished", status="Processing completed successfully. Have a Happy Hydro Day!",
+                  seconds=execution_time, output_dir=output_dir)
+
+    def post(self, event, **fields):
+        emit(self.events.put, event, **fields)
+
+    def on_event(self, event):
+        # Engine events, on the processing thread (or its writer thread)
+        self.event_log(event)
+        self.events.put(event)
+
+    def poll_events(self):
+        # Apply the queued events on the Tk thread, then look again shortly
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+            self.handle_event(event)
+        self.root.after(POLL_INTERVAL_MS, self.poll_events)
+
+    def handle_event(self, event):
+        kind = event["event"]
+        if kind == "output":
+            self.message_text.insert(tk.END, event["text"])
+            self.message_text.yview(tk.END)
+        elif kind == "message":
+            self.add_message(event["text"])
+        elif kind == "finished":
+            self.finish(event)
+        elif kind == "progress":
+            self.progress["value"] = event["percent"]
+        if kind == "chunk":
+            self.progress["value"] = 100 * (event["index"] + 1) / event["chunks"]
+        if kind in ("chunk", "pass", "run_end", "cancelled"):
+            self.add_message(self.event_log.describe(event))
+        if kind == "run_end" and self.event_log.trace_path is not None:
+            self.add_message(f"Profile trace written to {self.event_log.trace_path}")
+
+    def finish(self, event):
+        self.status_label['text'] = event["status"]
+        self.add_message(f"***{event['status']}***")
+        self.process_button["state"] = "normal"
+        self.cancel_button["state"] = "disabled"
+        self.cancel_token = None
+        if self.closing:
+            self.root.destroy()
+            return
+        if "output_dir" in event:
+            self.add_message(f"The function took {event['seconds']:.2f} seconds to run.")
+            self.progress["value"] = 100
+            os.startfile(event["output_dir"])
+
+    def cancel(self):
+        # The engine stops after the chunk it is on and removes the partial output
+        if self.cancel_token is not None:
+            self.cancel_token.cancel()
+            self.status_label['text'] = "Cancelling after the current chunk..."
+
+    def close(self):
+        # Closing mid-run cancels first, so the partial output is cleaned up
+        if self.worker is not None and self.worker.is_alive() and self.cancel_token is not None:
+            self.closing = True
+            self.cancel()
+        else:
+            self.root.destroy()
 
     def add_message(self, message):
         self.message_text.insert(tk.END, message + '\n')
@@ -114,8 +219,12 @@ class App:
 
         tk.Label(self.root, text="Choose File format:").grid(row=2, column=0, sticky="e")
         tk.OptionMenu(self.root, self.file_format_var, "BAG", "CSAR", 'GeoTiff').grid(row=2, column=1)
+        tk.Checkbutton(self.root, text="Profile", variable=self.profile_var).grid(row=2, column=2)
 
-        tk.Button(self.root, text="Process", command=self.process).grid(row=3, column=1, pady=10)
+        self.process_button = tk.Button(self.root, text="Process", command=self.process)
+        self.process_button.grid(row=3, column=1, pady=10)
+        self.cancel_button = tk.Button(self.root, text="Cancel", command=self.cancel, state="disabled")
+        self.cancel_button.grid(row=3, column=2, pady=10)
 
         self.progress_label = tk.Label(self.root, text="Progress:")
         self.progress_label.grid(row=4, column=0, padx=10, pady=10, sticky="e")
@@ -146,7 +255,14 @@ class App:
 def main():
     root = tk.Tk()
     app = App(root)
-    root.mainloop()
+    # Printed output, from any thread, reaches the message box through the
+    # queue; sys.stdout is replaced once for the whole session
+    original_stdout = sys.stdout
+    sys.stdout = QueueStream(app.events, original_stdout)
+    try:
+        root.mainloop()
+    finally:
+        sys.stdout = original_stdout
 
 
 if __name__ == "__main__":
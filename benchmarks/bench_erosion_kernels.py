@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Cross-check and benchmark of the per-chunk erosion kernels: the reference
+step-by-step implementation against the fused kernel.
+
+Usage:
+python benchmarks/bench_erosion_kernels.py [--size 2000] [--repeat 3] [--seeds 5] [--erode-width 1]
+"""
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from erode_core import KERNELS, parse_erode_width  # noqa: E402
+
+NO_DATA_VALUE = 1000000.0
+
+
+def make_survey_chunk(size, seed=0):
+    # Depths with scattered small holes, a few large holes and a nodata margin
+    rng = np.random.default_rng(seed)
+    chunk = rng.normal(-20, 3, (size, size)).astype(np.float32)
+    for _ in range(size * size // 2000):
+        r, c, s = rng.integers(0, size), rng.integers(0, size), rng.integers(1, 4)
+        chunk[r:r + s, c:c + s] = NO_DATA_VALUE
+    for _ in range(max(1, size * size // 40000)):
+        r, c, s = rng.integers(0, size), rng.integers(0, size), rng.integers(5, 60)
+        chunk[r:r + s, c:c + 2 * s] = NO_DATA_VALUE
+    chunk[:, : size // 50] = NO_DATA_VALUE
+    return chunk
+
+
+def main(size=2000, repeat=3, seeds=5, min_gap_size=6, erode_width=1):
+    # Cross-check on several seeds, including small chunks where edge effects dominate
+    for seed in range(seeds):
+        for chunk_size in (7, 64, size):
+            chunk = make_survey_chunk(chunk_size, seed)
+            expected = KERNELS["reference"](chunk, NO_DATA_VALUE, min_gap_size, erode_width=erode_width)
+            result = KERNELS["fused"](chunk, NO_DATA_VALUE, min_gap_size, erode_width=erode_width)
+            assert np.array_equal(expected, result), f"kernels disagree (seed {seed}, size {chunk_size})"
+    print(f"Kernels agree on {seeds} seeds (erode width {erode_width}).")
+
+    chunk = make_survey_chunk(size)
+    print(f"{'kernel':>10} {'best (s)':>10} {'Mpx/s':>8}")
+    for name, kernel in KERNELS.items():
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            kernel(chunk, NO_DATA_VALUE, min_gap_size, erode_width=erode_width)
+            best = min(best, time.perf_counter() - start)
+        print(f"{name:>10} {best:>10.3f} {chunk.size / best / 1e6:>8.1f}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Cross-check and benchmark the erosion kernels.')
+    parser.add_argument('--size', type=int, default=2000, help='Side length of the synthetic square chunk.')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timing repeats per kernel.')
+    parser.add_argument('--seeds', type=int, default=5, help='Number of random chunks to cross-check.')
+    parser.add_argument('--erode-width', type=parse_erode_width, default=1, help='Number of pixels trimmed off large gaps.')
+
+    args = parser.parse_args()
+
+    main(args.size, args.repeat, args.seeds, erode_width=args.erode_width)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of gap classification: per-region full-array masks vs. a single
+label-size lookup (erode_core.classify_gaps).
+
+Usage:
+python benchmarks/bench_gap_classification.py [--size 2000] [--repeat 3]
+"""
+import os
+import sys
+import time
+import numpy as np
+from skimage.measure import label, regionprops
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from erode_core import classify_gaps  # noqa: E402
+
+
+def classify_gaps_regionprops(labeled_mask, min_gap_size):
+    # The original per-region loop, kept here as the baseline
+    small_gaps_mask = np.zeros(labeled_mask.shape, dtype=np.uint8)
+    large_gaps_mask = np.zeros(labeled_mask.shape, dtype=np.uint8)
+    for region in regionprops(labeled_mask):
+        region_mask = (labeled_mask == region.label)
+        if region.area < min_gap_size:
+            small_gaps_mask[region_mask] = 1
+        else:
+            large_gaps_mask[region_mask] = 1
+    return small_gaps_mask, large_gaps_mask
+
+
+def make_gappy_mask(size, num_holes, seed=0):
+    # Solid data with num_holes random gaps of 1-16 pixels (inverted mask: 1 = gap)
+    rng = np.random.default_rng(seed)
+    gaps = np.zeros((size, size), dtype=np.uint8)
+    rows = rng.integers(0, size - 4, num_holes)
+    cols = rng.integers(0, size - 4, num_holes)
+    heights = rng.integers(1, 5, num_holes)
+    widths = rng.integers(1, 5, num_holes)
+    for r, c, h, w in zip(rows, cols, heights, widths):
+        gaps[r:r + h, c:c + w] = 1
+    return gaps
+
+
+def time_call(func, repeat, *args):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main(size=2000, repeat=3, min_gap_size=6):
+    print(f"{'holes':>8} {'regions':>8} {'regionprops (s)':>16} {'lookup (s)':>12} {'speedup':>9}")
+    for num_holes in (10, 100, 1000, 5000, 20000):
+        labeled_mask = label(make_gappy_mask(size, num_holes))
+        num_regions = int(labeled_mask.max())
+
+        # The baseline scales with regions, so only run it once
+        baseline_time, expected = time_call(classify_gaps_regionprops, 1, labeled_mask, min_gap_size)
+        lookup_time, result = time_call(classify_gaps, repeat, labeled_mask, min_gap_size)
+
+        assert np.array_equal(expected[0], result[0]) and np.array_equal(expected[1], result[1])
+        print(f"{num_holes:>8} {num_regions:>8} {baseline_time:>16.3f} {lookup_time:>12.4f} {baseline_time / lookup_time:>8.1f}x")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark gap classification strategies.')
+    parser.add_argument('--size', type=int, default=2000, help='Side length of the synthetic square chunk.')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timing repeats for the lookup method.')
+
+    args = parser.parse_args()
+
+    main(args.size, args.repeat)
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end benchmark suite on synthetic survey rasters.
+
+Generates bathymetry GeoTIFFs and BAGs with a controlled size, coverage
+fraction and gap-size distribution, then times the erosion workflows end to
+end and per stage (the occupancy and seam passes, then read, label,
+classify, morphology and write per chunk, from the engine's chunk events).
+Each case runs in a fresh process so its peak RSS is its own.
+Results are written as JSON; pass an earlier result file as --baseline to
+flag throughput or memory regressions (the exit status is 1 if any).
+Targets needing GDAL are reported as skipped when it is not installed.
+
+Usage:
+python benchmarks/bench_suite.py [--sizes 4000x4000,20000x8000] [--targets geotiff,bag-h5py]
+    [--chunk-heights 500,1000,2000] [--coverage 0.7] [--gap-density 50] [--gap-size 3]
+    [--data-dir bench_data] [--output bench_results.json] [--baseline baseline.json]
+"""
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from erode_events import EventLog, peak_memory_mb  # noqa: E402
+from erode_synthetic import NO_DATA_VALUE, synthetic_bands, write_synthetic_bag  # noqa: E402
+
+TARGETS = ("geotiff", "bag-h5py", "bag-gdal-elevation", "bag-gdal-replace")
+
+
+def write_synthetic_geotiff(path, raster_width, raster_height, **params):
+    from osgeo import gdal, osr
+    driver = gdal.GetDriverByName("GTiff")
+    dataset = driver.Create(path, raster_width, raster_height, 1, gdal.GDT_Float32,
+                            options=["COMPRESS=LZW", "TILED=YES", "BIGTIFF=IF_SAFER"])
+    dataset.SetGeoTransform((500000.0, 1.0, 0.0, 4000000.0, 0.0, -1.0))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32619)
+    dataset.SetProjection(srs.ExportToWkt())
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(NO_DATA_VALUE)
+    for start_row, data in synthetic_bands(raster_width, raster_height, **params):
+        band.WriteArray(data, 0, start_row)
+    dataset = None
+
+
+def synthetic_input(data_dir, target, raster_width, raster_height, **params):
+    # Inputs are cached by their parameters, since large ones take a while
+    extension = ".tif" if target == "geotiff" else ".bag"
+    name = "synthetic_{}x{}_cov{coverage}_gd{gap_density}_gs{gap_size}_s{seed}".format(raster_width, raster_height, **params)
+    path = os.path.join(data_dir, name + extension)
+    if not os.path.exists(path):
+        print(f"Generating {path}...")
+        writer = write_synthetic_geotiff if target == "geotiff" else write_synthetic_bag
+        writer(path + ".partial", raster_width, raster_height, **params)
+        os.replace(path + ".partial", path)
+    return path
+
+
+def run_case(case):
+    # Runs in a fresh process: erode one synthetic input and report timings
+    result = dict(status="failed", error=None)
+    work_dir = case["work_dir"]
+    os.makedirs(work_dir, exist_ok=True)
+    event_log = EventLog(console=False)
+    # The timings come from the events; the engine's console output (and the
+    # workflows' own messages) would only end up inside the results table
+    engine_options = dict(chunk_height=case["chunk_height"], overlap_factor=case["overlap_factor"],
+                          min_gap_size=case["min_gap_size"], tile_size=case["tile_size"], on_event=event_log,
+                          quiet=True)
+    try:
+        import erode_bag_functions
+        input_file = synthetic_input(case["data_dir"], case["target"], case["width"], case["height"], **case["params"])
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            if case["target"] == "geotiff":
+                from erode_geotiff_functions import erode_geotiff
+                erode_geotiff(input_file, work_dir, **engine_options)
+            elif case["target"] == "bag-h5py":
+                erode_bag_functions.erode_bag_h5py(input_file, os.path.join(work_dir, "eroded.bag"), **engine_options)
+            elif case["target"] == "bag-gdal-elevation":
+                erode_bag_functions.erode_outer_edge_elevation_chunked(input_file, work_dir, **engine_options)
+            else:
+                erode_bag_functions.replace_bag_bands(input_file, work_dir, os.path.join(work_dir, "eroded.bag"),
+                                                      **engine_options)
+        seconds = time.perf_counter() - start
+        stages = {name: round(value, 4) for name, value in sorted(event_log.stage_seconds.items())}
+        stages["other"] = round(seconds - sum(event_log.stage_seconds.values()), 4)
+        result.update(status="ok", seconds=round(seconds, 4),
+                      mpx_per_s=round(case["width"] * case["height"] / 1e6 / seconds, 3), stages=stages)
+    except ImportError as error:
+        result.update(status="skipped", error=str(error))
+    except Exception:
+        result["error"] = traceback.format_exc()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    result["peak_rss_mb"] = peak_memory_mb()
+    return result
+
+
+def compare(results, baseline, tolerance):
+    # Cases more than tolerance slower or larger than in the baseline
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get("cases", {}).get(name)
+        if result["status"] != "ok" or before is None or before.get("status") != "ok":
+            continue
+        if result["mpx_per_s"] < before["mpx_per_s"] * (1 - tolerance):
+            regressions.append(f"{name}: {result['mpx_per_s']:.2f} Mpx/s vs baseline {before['mpx_per_s']:.2f}")
+        if before.get("peak_rss_mb") and result["peak_rss_mb"] > before["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(f"{name}: peak RSS {result['peak_rss_mb']:.0f} MB vs baseline {before['peak_rss_mb']:.0f}")
+    return regressions
+
+
+def main(sizes, targets, chunk_heights, params, data_dir, output, baseline=None, tolerance=0.1,
+         overlap_factor=0.1, min_gap_size=6, tile_size=None):
+    os.makedirs(data_dir, exist_ok=True)
+    cases = {}
+    for width, height in sizes:
+        for target in targets:
+            for chunk_height in chunk_heights:
+                name = f"{target} {width}x{height} chunk{chunk_height}" + (f" tile{tile_size}" if tile_size else "")
+                cases[name] = dict(target=target, width=width, height=height, chunk_height=chunk_height,
+                                   overlap_factor=overlap_factor, min_gap_size=min_gap_size, tile_size=tile_size,
+                                   params=params, data_dir=data_dir,
+                                   work_dir=os.path.join(data_dir, "work_" + name.replace(" ", "_")))
+
+    results = {}
+    print(f"{'case':<48} {'status':>8} {'seconds':>9} {'Mpx/s':>8} {'RSS MB':>8}")
+    for name, case in cases.items():
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+            result = pool.submit(run_case, case).result()
+        results[name] = result
+        if result["status"] == "ok":
+            print(f"{name:<48} {'ok':>8} {result['seconds']:>9.2f} {result['mpx_per_s']:>8.2f} {result['peak_rss_mb'] or 0:>8.0f}")
+            print("    " + ", ".join(f"{stage} {seconds:.2f} s" for stage, seconds in result["stages"].items()))
+        else:
+            print(f"{name:<48} {result['status']:>8}")
+            print("    " + (result["error"] or "").strip().splitlines()[-1])
+
+    report = dict(created=datetime.now().isoformat(timespec="seconds"), python=platform.python_version(),
+                  numpy=np.__version__, machine=platform.machine(), processor=platform.processor(),
+                  cpu_count=os.cpu_count(), params=params, cases=results)
+    with open(output, "w") as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f"Results written to {output}")
+
+    if baseline is None:
+        return 0
+    with open(baseline) as baseline_file:
+        regressions = compare(results, json.load(baseline_file), tolerance)
+    for regression in regressions:
+        print("REGRESSION " + regression)
+    print(f"{len(regressions)} regressions against {baseline} (tolerance {tolerance:.0%})")
+    return 1 if regressions else 0
+
+
+def parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark the erosion workflows on synthetic survey rasters.')
+    parser.add_argument('--sizes', default='4000x4000', help='Comma separated WIDTHxHEIGHT raster sizes.')
+    parser.add_argument('--targets', default='geotiff,bag-h5py,bag-gdal-elevation,bag-gdal-replace',
+                        help='Comma separated workflows to time: ' + ', '.join(TARGETS) + '.')
+    parser.add_argument('--chunk-heights', default='1000', help='Comma separated chunk heights to compare.')
+    parser.add_argument('--overlap-factor', type=float, default=0.1, help='Chunk overlap factor.')
+    parser.add_argument('--tile-size', type=int, default=None, help='Use 2D tiles of about this size instead of strips.')
+    parser.add_argument('--min-gap-size', type=int, default=6, help='Gaps smaller than this are kept.')
+    parser.add_argument('--coverage', type=float, default=0.7, help='Fraction of each row inside the survey swath.')
+    parser.add_argument('--gap-density', type=float, default=50.0, help='Holes per megapixel.')
+    parser.add_argument('--gap-size', type=float, default=3.0, help='Mean side length of a hole in pixels.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic rasters.')
+    parser.add_argument('--data-dir', default='bench_data', help='Directory caching the synthetic inputs.')
+    parser.add_argument('--output', default='bench_results.json', help='Where to write the JSON results.')
+    parser.add_argument('--baseline', default=None, help='Earlier JSON results to compare against.')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Allowed slowdown or memory growth before a regression is flagged.')
+
+    args = parser.parse_args()
+
+    targets = args.targets.split(',')
+    for target in targets:
+        if target not in TARGETS:
+            parser.error(f"unknown target {target}")
+    params = dict(coverage=args.coverage, gap_density=args.gap_density, gap_size=args.gap_size, seed=args.seed)
+    sys.exit(main([parse_size(size) for size in args.sizes.split(',')], targets,
+                  [int(chunk_height) for chunk_height in args.chunk_heights.split(',')], params,
+                  args.data_dir, args.output, args.baseline, args.tolerance, args.overlap_factor,
+                  args.min_gap_size, args.tile_size))
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory erosion API: erode NumPy arrays, or a stream of buffered chunks,
+without going through files. The BAG and GeoTIFF workflows run the same
+engine; they only supply windowed readers and writers.
+
+@author: Anthony.R.Klemm
+"""
+import time
+from functools import partial
+import numpy as np
+from erode_core import KERNELS, drop_mask, erode_raster, erode_read_chunks
+from erode_occupancy import OCCUPANCY_MIXED
+from erode_windows import check_erode_width
+
+
+def open_array_reader(data, block_shape=None):
+    # read_window over an in-memory array; picklable through partial
+    def read_window(xoff, yoff, xsize, ysize):
+        return data[yoff:yoff + ysize, xoff:xoff + xsize]
+
+    if block_shape is not None:
+        read_window.block_shape = block_shape
+    return read_window
+
+
+def check_buffer(buffer, shape, dtype, name):
+    if buffer.shape != shape or buffer.dtype != dtype:
+        raise ValueError(f"{name} must be a {dtype} array of shape {shape}, not {buffer.dtype} {buffer.shape}")
+
+
+def erode_array(data, no_data_value, min_gap_size=6, out=None, mask=None, kernel="fused", erode_width=1,
+                **engine_options):
+    # Erode a 2D array and return the result, written into out if given (out
+    # may be data itself). mask, a boolean array of the same shape, is filled
+    # with the keep-mask: True where the result still has data. erode_width
+    # is the number of pixels trimmed off the edges of large gaps.
+    # Without engine_options the whole array is eroded as one chunk. Engine
+    # options (chunk_height, tile_size, workers, max_memory, ...) run
+    # erode_core.erode_raster over the array instead, which bounds the
+    # temporaries by the chunk size and gives the same result; out must then
+    # be a separate array, since every chunk reads its halo from data. The
+    # engine prints nothing unless quiet=False is passed.
+    data = np.asarray(data)
+    check_erode_width(erode_width)
+    if np.isnan(no_data_value):
+        raise ValueError("no_data_value must not be NaN; replace NaN with a finite nodata value first")
+    if out is None:
+        out = np.empty_like(data)
+    check_buffer(out, data.shape, data.dtype, "out")
+    if mask is not None:
+        check_buffer(mask, data.shape, np.dtype(bool), "mask")
+
+    if engine_options:
+        if np.shares_memory(out, data):
+            raise ValueError("out must not overlap data when eroding in chunks")
+
+        def write_window(array, xoff, yoff):
+            rows, cols = array.shape
+            out[yoff:yoff + rows, xoff:xoff + cols] = array
+
+        raster_height, raster_width = data.shape
+        engine_options.setdefault("quiet", True)
+        erode_raster(partial(open_array_reader, data), write_window, raster_width, raster_height, no_data_value,
+                     min_gap_size=min_gap_size, kernel=kernel, erode_width=erode_width, **engine_options)
+    elif kernel == "fused":
+        drop = drop_mask(data, no_data_value, min_gap_size, erode_width=erode_width)
+        np.copyto(out, data)
+        out[drop] = no_data_value
+    else:
+        np.copyto(out, KERNELS[kernel](data, no_data_value, min_gap_size, erode_width=erode_width))
+
+    if mask is not None:
+        np.not_equal(out, no_data_value, out=mask)
+    return out
+
+
+def keep_mask(data, no_data_value, min_gap_size=6, out=None, kernel="fused", erode_width=1, **engine_options):
+    # Only the keep-mask of erode_array, e.g. to filter companion grids such
+    # as uncertainty; the fused kernel then never builds the eroded array
+    data = np.asarray(data)
+    if out is None:
+        out = np.empty(data.shape, dtype=bool)
+    if engine_options or kernel != "fused":
+        erode_array(data, no_data_value, min_gap_size, mask=out, kernel=kernel, erode_width=erode_width, **engine_options)
+        return out
+    check_buffer(out, data.shape, np.dtype(bool), "out")
+    np.not_equal(data, no_data_value, out=out)
+    out &= ~drop_mask(data, no_data_value, min_gap_size, erode_width=erode_width)
+    return out
+
+
+def erode_chunks(chunks, no_data_value, min_gap_size=6, kernel="fused", masks=False, erode_width=1):
+    # Generator form: erode an iterator of (window, buffered chunk) or
+    # (window, buffered chunk, edge_areas) items, windows as planned by
+    # erode_windows, and yield (window, eroded core) in the same order, or
+    # (window, eroded core, keep-mask) with masks. Chunks are taken one at a
+    # time, so a pipeline can stream a raster through without holding it.
+    # Gaps are sized within each buffered chunk, unless edge_areas from
+    # erode_labels.seam_gap_areas give their whole-raster areas. Chunks need
+    # an erode_windows.erosion_halo(erode_width) halo for an exact result.
+    def reads():
+        for item in chunks:
+            window, chunk_data = item[0], np.asarray(item[1])
+            edge_areas = item[2] if len(item) > 2 else None
+            yield (window, OCCUPANCY_MIXED, edge_areas), (chunk_data, time.time(), 0.0)
+
+    for window, core, _ in erode_read_chunks(reads(), no_data_value, min_gap_size, kernel, erode_width=erode_width):
+        yield (window, core, core != no_data_value) if masks else (window, core)
@@ -8,14 +8,25 @@ Created on Tue May  2 15:40:29 2023
 import os
 import numpy as np
 from osgeo import gdal
-from skimage import morphology
-from skimage.measure import label, regionprops
+from erode_checkpoint import ChunkCheckpoint, remove_partial_output, source_fingerprint
+from erode_core import add_engine_arguments, engine_options_from_args, erode_raster
+from erode_events import ErosionCancelled, report_progress
+from erode_io import bag_window_reader, bag_window_writer, create_output_geotiff, open_bag_reader, open_geotiff_reader, open_input
+from erode_planner import dry_run
 import h5py
 import shutil
 import time
+from functools import partial
 
 start_time = time.time()
 
+# NoDataValue defined by the BAG specification for the elevation and uncertainty grids
+BAG_NO_DATA_VALUE = 1000000.0
+
+# Datasets on the elevation grid that are not pixel values: variable
+# resolution refinement tables
+NON_PIXEL_LAYER_PREFIXES = ("varres_",)
+
 def bag_to_elevation_geotiff(input_bag, output_dir):
     dataset = gdal.Open(input_bag, gdal.GA_ReadOnly)
     options = ["-co", "COMPRESS=LZW"]
@@ -24,16 +35,8 @@ def bag_to_elevation_geotiff(input_bag, output_dir):
     dataset = None
     return full_elevation_tiff
 
-def bag_to_uncertainty_geotiff(input_bag, output_dir):
-    dataset = gdal.Open(input_bag, gdal.GA_ReadOnly)
-    options = ["-co", "COMPRESS=LZW"]
-    gdal.Translate(output_dir +'/'+ 'full_uncertainty_tiff.tif', dataset, bandList=[2], options=options)
-    full_uncertainty_tiff = output_dir +'/'+ 'full_uncertainty_tiff.tif'
-    dataset = None
-    return full_uncertainty_tiff
-
 
-def erode_outer_edge_elevation_chunked(input_bag, output_dir, chunk_height=1000, overlap_factor=0.1, min_gap_size=6):
+def erode_outer_edge_elevation_chunked(input_bag, output_dir, chunk_height=1000, overlap_factor=0.1, min_gap_size=6, write_window=None, **engine_options):
     full_elevation_tiff = bag_to_elevation_geotiff(input_bag, output_dir)
     dataset = gdal.Open(full_elevation_tiff)
     band = dataset.GetRasterBand(1)
@@ -42,156 +45,184 @@ def erode_outer_edge_elevation_chunked(input_bag, output_dir, chunk_height=1000,
     raster_height = dataset.RasterYSize
     no_data_value = band.GetNoDataValue()
     
-    # Calculate the overlap in terms of pixels
-    overlap_pixels = int(chunk_height * overlap_factor)
-    
-    # Resultant array to store the eroded data
-    eroded_data = np.full((raster_height, raster_width), no_data_value)
-    
-    # Calculate the number of chunks
-    overlap_pixels = int(chunk_height * overlap_factor)
-    num_chunks = max(1, ((raster_height - overlap_pixels - 1) // (chunk_height - overlap_pixels)) + 1)
-    print(f"Number of chunks: {num_chunks}")
-    
-    # Iterate over the raster in chunks
-    for i, start_row in enumerate(range(0, raster_height, chunk_height - overlap_pixels)):
-        if start_row >= raster_height:
-            break
-        end_row = min(start_row + chunk_height, raster_height)
-        print(f"Processing chunk {i + 1} of {num_chunks}...")
-        
-        # Read the chunk data with buffer
-        buffer_size = overlap_pixels
-        buffer_start_row = max(0, start_row - buffer_size)
-        buffer_end_row = min(raster_height, end_row + buffer_size)
-        chunk_data = band.ReadAsArray(0, buffer_start_row, raster_width, buffer_end_row - buffer_start_row)
-        
-        # Create a binary mask based on the NoDataValue
-        binary_mask = np.where(chunk_data != no_data_value, 1, 0).astype(np.uint8)
-
-        # Invert binary mask to focus on gaps
-        inverted_binary_mask = np.where(binary_mask == 0, 1, 0).astype(np.uint8)
-
-        # Label connected components in the inverted binary mask
-        labeled_mask = label(inverted_binary_mask)
-
-        # Create masks for small and large gaps
-        small_gaps_mask = np.zeros_like(binary_mask)
-        large_gaps_mask = np.zeros_like(binary_mask)
-
-        for region in regionprops(labeled_mask):
-            region_mask = (labeled_mask == region.label)
-            if region.area < min_gap_size:
-                small_gaps_mask[region_mask] = 1
-            else:
-                large_gaps_mask[region_mask] = 1
-        
-        # Dilate large gaps
-        dilated_large_gaps_mask = morphology.binary_dilation(large_gaps_mask, morphology.square(5))
-
-        # Erode all edges, including gaps
-        eroded_mask = morphology.binary_erosion(binary_mask, morphology.square(3))
-
-        # Add back in data values from dilated large gaps mask and small gaps mask
-        eroded_chunk = np.where(eroded_mask == 1, chunk_data, no_data_value)
-        eroded_chunk[~dilated_large_gaps_mask & (eroded_mask == 0)] = chunk_data[~dilated_large_gaps_mask & (eroded_mask == 0)]
-        eroded_chunk[small_gaps_mask == 1] = chunk_data[small_gaps_mask == 1]
-        
-        # Remove buffer
-        buffer_rows_to_remove = buffer_size if start_row != 0 else 0
-        final_eroded_chunk = eroded_chunk[buffer_rows_to_remove : buffer_rows_to_remove + (end_row - start_row), :]
-        
-        # Store the eroded chunk data in the resultant array
-        eroded_data[start_row:end_row, :] = final_eroded_chunk
+    # Stream each eroded chunk into a tiled TIFF unless the caller supplies its own writer
+    eroded_elevation_tiff = None
+    eroded_dataset = None
+    if write_window is None:
+        eroded_elevation_tiff = output_dir + '/eroded_elevation_tiff.tif'
+        eroded_dataset = create_output_geotiff(eroded_elevation_tiff, dataset, band.DataType, no_data_value)
+        write_window = eroded_dataset.GetRasterBand(1).WriteArray
     
-    # Save the eroded data as a TIFF (this can be modified based on requirements)
-    driver = gdal.GetDriverByName('GTiff')
-    options = ["COMPRESS=LZW"]
-    eroded_dataset = driver.Create(output_dir + '/eroded_elevation_tiff.tif', raster_width, raster_height, 1, band.DataType, options=options)
-    eroded_dataset.SetGeoTransform(dataset.GetGeoTransform())
-    eroded_dataset.SetProjection(dataset.GetProjection())
-    eroded_band = eroded_dataset.GetRasterBand(1)
-    eroded_band.WriteArray(eroded_data)
-    eroded_band.SetNoDataValue(no_data_value)
-    eroded_band.FlushCache()
+    erode_raster(partial(open_geotiff_reader, full_elevation_tiff), write_window, raster_width, raster_height, no_data_value,
+                 chunk_height, overlap_factor, min_gap_size, **engine_options)
 
     # Cleanup
+    if eroded_dataset is not None:
+        eroded_dataset.GetRasterBand(1).FlushCache()
     dataset = None
     eroded_dataset = None
     print('***elevation band erosion complete***')
-    return output_dir + '/eroded_elevation_tiff.tif'
-
-def replace_bag_bands(input_bag, output_dir, eroded_bag_file):
-    # Copy the original BAG file to a new file with _eroded suffix
-    shutil.copy2(input_bag, eroded_bag_file)
-
-    # Open the eroded BAG file in read-write mode
-    with h5py.File(eroded_bag_file, "r+") as bag:
-        # Open the elevation GeoTIFF file
-        eroded_elevation_tiff = erode_outer_edge_elevation_chunked(input_bag, output_dir)
-        elevation_ds = gdal.Open(eroded_elevation_tiff, gdal.GA_ReadOnly)
-        
-        # Read the elevation data as a numpy array
-        elevation = elevation_ds.GetRasterBand(1).ReadAsArray()
-        no_data_value = elevation_ds.GetRasterBand(1).GetNoDataValue()
-
-        # Create a binary mask based on the NoDataValue
-        binary_mask = np.where(elevation != no_data_value, 1, 0).astype(np.uint8)
-
-        # Flip the elevation array along the vertical axis
-        elevation = np.flipud(elevation)
-
-        # Replace the elevation data in the BAG file
-        bag["/BAG_root/elevation"][:] = elevation
-
-        # Open the uncertainty GeoTIFF file
-        full_uncertainty_tiff = bag_to_uncertainty_geotiff(input_bag, output_dir)
-        uncertainty_ds = gdal.Open(full_uncertainty_tiff, gdal.GA_ReadOnly)
-        
-        # Read the uncertainty data as a numpy array
-        uncertainty = uncertainty_ds.GetRasterBand(1).ReadAsArray()
-        
-        # Filter the uncertainty data using the binary mask
-        filtered_uncertainty = np.where(binary_mask == 1, uncertainty, no_data_value)
-        
-        # Flip the filtered uncertainty array along the vertical axis
-        filtered_uncertainty = np.flipud(filtered_uncertainty)
-
-        # Replace the uncertainty data in the BAG file
-        bag["/BAG_root/uncertainty"][:] = filtered_uncertainty
-
-        # Close the elevation and uncertainty datasets
-        elevation_ds = None
-        uncertainty_ds = None
+    return eroded_elevation_tiff
+
+def bag_opens(bag_file):
+    # An HDF5 file killed mid-write is often left unopenable
+    try:
+        with h5py.File(bag_file, "r+"):
+            return True
+    except OSError:
+        return False
+
+def start_bag_copy(input_bag, eroded_bag_file, resume=False):
+    # Copy the original BAG file to a new file with _eroded suffix. With
+    # resume, a partial copy left by an interrupted run of the same source is
+    # reused along with its checkpoint, unless it no longer opens; returns
+    # the checkpoint or None.
+    checkpoint = ChunkCheckpoint(eroded_bag_file, source_fingerprint(input_bag))
+    if resume and checkpoint.resumable() and not bag_opens(eroded_bag_file):
+        print(f"***{eroded_bag_file} cannot be opened, starting it again***")
+        checkpoint.reset()
+    if not (resume and checkpoint.resumable()):
+        # A stale manifest must not vouch for the new copy
+        checkpoint.reset()
+        shutil.copy2(input_bag, eroded_bag_file)
+    return checkpoint if resume else None
+
+def gridded_layers(bag):
+    # Paths of the datasets under /BAG_root on the elevation grid, other than
+    # the elevation itself: the uncertainty and any optional surfaces
+    # (nominal elevation, standard deviation, georeferenced metadata keys...).
+    # Compound tables and variable resolution refinements are left alone.
+    shape = bag["/BAG_root/elevation"].shape
+    layers = []
+
+    def visit(name, item):
+        path = "/BAG_root/" + name
+        if (isinstance(item, h5py.Dataset) and item.shape == shape and path != "/BAG_root/elevation"
+                and item.dtype.fields is None and not name.split("/")[-1].startswith(NON_PIXEL_LAYER_PREFIXES)):
+            layers.append(path)
+
+    bag["/BAG_root"].visititems(visit)
+    return sorted(layers)
+
+
+def layer_no_data_value(dataset):
+    # Floating point layers use the BAG NoDataValue; integer layers (counts,
+    # metadata keys) their HDF5 fill value, which is 0 unless set
+    if np.issubdtype(dataset.dtype, np.floating):
+        return BAG_NO_DATA_VALUE
+    return dataset.fillvalue
+
+
+def masked_layers_bytes(source):
+    # Bytes per pixel masked_layers_writer allocates beyond the eroded window:
+    # the keep mask, then for each layer its window (while the previous one is
+    # still held), the masked copy and the contiguous copy h5py writes from
+    itemsizes = [source[path].dtype.itemsize for path in gridded_layers(source)]
+    return 1 + 4 * max(itemsizes) if itemsizes else 0
+
+
+def bag_write_bytes(input_bag):
+    # masked_layers_bytes of a BAG file, for planning before it is eroded
+    with h5py.File(input_bag, "r") as source:
+        return masked_layers_bytes(source)
+
+
+def masked_layers_writer(source, bag, no_data_value=BAG_NO_DATA_VALUE):
+    # write_window for eroded elevation windows: writes the elevation, then
+    # reads the same window of every other gridded layer once from the source
+    # BAG and writes it once, with that layer's NoDataValue wherever the
+    # eroded elevation has none, so all layers keep the same footprint
+    write_elevation = bag_window_writer(bag["/BAG_root/elevation"])
+    paths = gridded_layers(source)
+    layers = [(bag_window_reader(source[path]), bag_window_writer(bag[path]), layer_no_data_value(source[path]))
+              for path in paths]
+    print(f"Masking {len(paths)} layers with the eroded elevation: "
+          + ", ".join(path[len("/BAG_root/"):] for path in paths))
+
+    def write_window(eroded_elevation, xoff, yoff):
+        write_elevation(eroded_elevation, xoff, yoff)
+        keep = eroded_elevation != no_data_value
+        rows, cols = eroded_elevation.shape
+        for read_layer, write_layer, fill in layers:
+            layer = read_layer(xoff, yoff, cols, rows)
+            write_layer(np.where(keep, layer, fill).astype(layer.dtype, copy=False), xoff, yoff)
+
+    # For the memory planner
+    write_window.bytes_per_pixel = masked_layers_bytes(source)
+    return write_window
+
+
+def replace_bag_bands(input_bag, output_dir, eroded_bag_file, resume=False, **engine_options):
+    checkpoint = start_bag_copy(input_bag, eroded_bag_file, resume)
+
+    # The elevation is eroded from its GeoTIFF; the other layers are read
+    # window by window from the source BAG alongside the elevation chunks
+    with h5py.File(input_bag, "r") as source, h5py.File(eroded_bag_file, "r+") as bag:
+        if checkpoint is not None:
+            checkpoint.flush = bag.flush
+        write_window = masked_layers_writer(source, bag)
+        erode_outer_edge_elevation_chunked(input_bag, output_dir, write_window=write_window, checkpoint=checkpoint, **engine_options)
+
+def erode_bag_h5py(input_bag, eroded_bag_file, chunk_height=1000, overlap_factor=0.1, min_gap_size=6, resume=False, **engine_options):
+    # Erode the BAG grids directly through h5py: hyperslabs are read from the
+    # input file and written into the output copy, with no intermediate TIFFs.
+    # Every other gridded layer is masked in the same pass.
+    checkpoint = start_bag_copy(input_bag, eroded_bag_file, resume)
+
+    with h5py.File(input_bag, "r") as source, h5py.File(eroded_bag_file, "r+") as bag:
+        raster_height, raster_width = source["/BAG_root/elevation"].shape
+        if checkpoint is not None:
+            checkpoint.flush = bag.flush
+        write_window = masked_layers_writer(source, bag)
+
+        erode_raster(partial(open_bag_reader, input_bag, "elevation"), write_window, raster_width, raster_height, BAG_NO_DATA_VALUE,
+                     chunk_height, overlap_factor, min_gap_size, checkpoint=checkpoint, **engine_options)
+
+    print('***elevation band erosion complete***')
+    return eroded_bag_file
 
 def remove_intermediate_files(output_dir):
     print('***removing intermediate files***')
 
-    files_to_remove = ['full_elevation_tiff.tif', 'full_uncertainty_tiff.tif', 'eroded_elevation_tiff.tif']
+    files_to_remove = ['full_elevation_tiff.tif', 'eroded_elevation_tiff.tif']
 
     for file in files_to_remove:
         file_path = os.path.join(output_dir, file)
         if os.path.exists(file_path):
             os.remove(file_path)
 
-def process_bag(input_bag, output_dir, progress, root):
+def process_bag(input_bag, output_dir, progress, root, engine="h5py", scratch_dir=None, **engine_options):
+    # engine_options (workers, tile_size, kernel, ...) are passed through to erode_core.erode_raster.
+    # The gdal engine's intermediate TIFFs go to scratch_dir (default: output_dir).
+    # Coarse progress is sent to engine_options' on_event as progress events
+    # and shown on the Tk progress bar if given (printed if neither is).
+    # A run cancelled through engine_options' cancel token removes its partial
+    # output, unless it can be resumed.
+    on_event = engine_options.get("on_event")
+    if scratch_dir is None:
+        scratch_dir = output_dir
     eroded_bag_file = os.path.join(output_dir, os.path.splitext(os.path.basename(input_bag))[0] + "_eroded" + os.path.splitext(input_bag)[1])
-    if progress is not None: progress["value"] = 25
-    else: print("Progress: 25%")
-    if root is not None: root.update_idletasks()
-    bag_to_elevation_geotiff(input_bag, output_dir)
-    if progress is not None: progress["value"] = 50
-    else: print("Progress: 50%")
-    if root is not None: root.update_idletasks()
-    bag_to_uncertainty_geotiff(input_bag, output_dir)
-    if progress is not None: progress["value"] = 75
-    else: print("Progress: 75%")
-    if root is not None: root.update_idletasks()
-    replace_bag_bands(input_bag, output_dir, eroded_bag_file)
-    remove_intermediate_files(output_dir)
-    if progress is not None: progress["value"] = 100
-    else: print("Progress: 100%")
-    if root is not None: root.update_idletasks()
+    if engine_options.get("resume") and ChunkCheckpoint(eroded_bag_file, source_fingerprint(input_bag)).finished():
+        print(f"***{eroded_bag_file} was already completed, skipping***")
+        return eroded_bag_file
+    if engine not in ("h5py", "gdal"):
+        raise ValueError(f"Unknown BAG engine: {engine}")
+    report_progress(25, progress, root, on_event)
+    try:
+        if engine == "h5py":
+            erode_bag_h5py(input_bag, eroded_bag_file, **engine_options)
+        else:
+            bag_to_elevation_geotiff(input_bag, scratch_dir)
+            report_progress(50, progress, root, on_event)
+            replace_bag_bands(input_bag, scratch_dir, eroded_bag_file, **engine_options)
+            remove_intermediate_files(scratch_dir)
+    except ErosionCancelled:
+        if engine == "gdal":
+            remove_intermediate_files(scratch_dir)
+        if not engine_options.get("resume"):
+            remove_partial_output(eroded_bag_file)
+        raise
+    report_progress(100, progress, root, on_event)
     return eroded_bag_file
 
     
@@ -202,8 +233,17 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Process a BAG file to erode its outer edges.')
     parser.add_argument('input_bag', help='The path to the input BAG file.')
     parser.add_argument('output_dir', help='The directory to output the processed BAG file to.')
+    parser.add_argument('--engine', choices=['h5py', 'gdal'], default='h5py',
+                        help='h5py erodes the BAG grids in place; gdal round-trips them through GeoTIFFs.')
+    add_engine_arguments(parser)
     
     args = parser.parse_args()
     
+    if args.dry_run:
+        # Show the chunk plan and its predicted memory, without eroding
+        dry_run(*open_input(args.input_bag)[:3], write_bytes=bag_write_bytes(args.input_bag),
+                **engine_options_from_args(args))
+        raise SystemExit
+    
     # Call the process_bag function with the input arguments.
-    process_bag(args.input_bag, args.output_dir, None, None)
+    process_bag(args.input_bag, args.output_dir, None, None, engine=args.engine, **engine_options_from_args(args))
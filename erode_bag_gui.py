@@ -2,8 +2,21 @@ import tkinter as tk
 from tkinter import filedialog
 from tkinter import ttk
 from erode_bag_functions import process_bag
+from erode_events import CancelToken, ErosionCancelled, EventLog, emit
 import os
+import queue
+import threading
 import time
+import traceback
+
+# Milliseconds between two looks at the event queue
+POLL_INTERVAL_MS = 100
+
+# The processing thread never touches the widgets: it queues the engine's
+# events, and the Tk loop applies them in poll_events
+events = queue.Queue()
+event_log = EventLog()
+cancel_token = None
 
 
 def browse_input_bag():
@@ -15,18 +28,67 @@ def browse_output_dir():
     output_dir_var.set(output_dir)
     
 def process():
+    global cancel_token
+    input_bag = input_bag_var.get()
+    output_dir = output_dir_var.get()
+    progress["value"] = 0
+    status_label['text'] = ""
+    cancel_token = CancelToken()
+    process_button["state"] = "disabled"
+    cancel_button["state"] = "normal"
+    threading.Thread(target=run, args=(input_bag, output_dir, cancel_token), daemon=True).start()
+
+def on_event(event):
+    # Chunk progress is printed to the console as before, and queued for the widgets
+    event_log(event)
+    events.put(event)
+
+def run(input_bag, output_dir, cancel_token):
+    # Runs on the processing thread
     start_time = time.time()
     print('***commencing erosion process***')
     print('***NOTE: disregard warnings about cornerPoints or SingleCRS***')
-    input_bag = input_bag_var.get()
-    output_dir = output_dir_var.get()
-    process_bag(input_bag, output_dir, progress, root)
-    status_label['text'] = "Processing completed successfully!"
+    try:
+        process_bag(input_bag, output_dir, None, None, on_event=on_event, cancel=cancel_token)
+    except ErosionCancelled:
+        emit(events.put, "finished", status="Processing cancelled.")
+        return
+    except Exception:
+        traceback.print_exc()
+        emit(events.put, "finished", status="Processing failed, see the console.")
+        return
     print("***Processing completed successfully!***")
     end_time = time.time()
     execution_time = end_time - start_time
     print(f"The function took {execution_time:.2f} seconds to run.")
-    os.startfile(output_dir)
+    emit(events.put, "finished", status="Processing completed successfully!", output_dir=output_dir)
+
+def cancel():
+    # The engine stops after the chunk it is on and removes the partial output
+    if cancel_token is not None:
+        cancel_token.cancel()
+        status_label['text'] = "Cancelling after the current chunk..."
+
+def poll_events():
+    # Apply the queued events on the Tk thread, then look again shortly
+    global cancel_token
+    while True:
+        try:
+            event = events.get_nowait()
+        except queue.Empty:
+            break
+        if event["event"] == "chunk":
+            progress["value"] = 100 * (event["index"] + 1) / event["chunks"]
+        elif event["event"] == "progress":
+            progress["value"] = event["percent"]
+        elif event["event"] == "finished":
+            status_label['text'] = event["status"]
+            process_button["state"] = "normal"
+            cancel_button["state"] = "disabled"
+            cancel_token = None
+            if "output_dir" in event:
+                os.startfile(event["output_dir"])
+    root.after(POLL_INTERVAL_MS, poll_events)
 
 def create_widgets(root):
     tk.Label(root, text="Input BAG file:").grid(row=0, column=0, sticky="e")
@@ -37,7 +99,10 @@ def create_widgets(root):
     tk.Entry(root, textvariable=output_dir_var, width=40).grid(row=1, column=1)
     tk.Button(root, text="Browse", command=browse_output_dir).grid(row=1, column=2)
 
-    tk.Button(root, text="Process", command=process).grid(row=2, column=1, pady=10)
+    process_button = tk.Button(root, text="Process", command=process)
+    process_button.grid(row=2, column=1, pady=10)
+    cancel_button = tk.Button(root, text="Cancel", command=cancel, state="disabled")
+    cancel_button.grid(row=2, column=2, pady=10)
 
     progress_label = tk.Label(root, text="Progress:")
     progress_label.grid(row=3, column=0, padx=10, pady=10, sticky="e")
@@ -50,7 +115,7 @@ def create_widgets(root):
     status_label = tk.Label(root, text="")
     status_label.grid(row=4, column=1, padx=10, pady=10)
 
-    return progress, status_label
+    return progress, status_label, process_button, cancel_button
 
 root = tk.Tk()
 root.title("Erode BAG GUI")
@@ -58,6 +123,7 @@ root.title("Erode BAG GUI")
 input_bag_var = tk.StringVar()
 output_dir_var = tk.StringVar()
 
-progress, status_label = create_widgets(root)
+progress, status_label, process_button, cancel_button = create_widgets(root)
+poll_events()
 
 root.mainloop()
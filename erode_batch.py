@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Batch mode: erode every BAG and GeoTIFF in a set of directories or globs,
+scheduled across a pool of job processes, and write a JSON run summary.
+
+@author: Anthony.R.Klemm
+"""
+import glob
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime
+from erode_events import peak_memory_mb
+
+BAG_EXTENSIONS = ('.bag',)
+GEOTIFF_EXTENSIONS = ('.tif', '.tiff')
+
+
+def find_inputs(patterns, recursive=False):
+    # Expand directories and glob patterns into a sorted list of BAG/GeoTIFF files
+    found = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '**', '*') if recursive else os.path.join(pattern, '*')
+        for path in glob.glob(pattern, recursive=recursive):
+            if os.path.isfile(path) and path.lower().endswith(BAG_EXTENSIONS + GEOTIFF_EXTENSIONS):
+                found.add(os.path.abspath(path))
+    return sorted(found)
+
+
+def input_format(input_file):
+    return 'BAG' if input_file.lower().endswith(BAG_EXTENSIONS) else 'GeoTiff'
+
+
+def run_job(job):
+    # Runs in its own process: erode one file with its own output and scratch
+    # directories, and report what happened
+    from erode_bag_functions import process_bag
+    from erode_geotiff_functions import process_geotiff
+
+    result = dict(input=job['input'], format=input_format(job['input']), status='failed', output=None, error=None)
+    summary = {}
+    start = time.time()
+    os.makedirs(job['output_dir'], exist_ok=True)
+    os.makedirs(job['scratch_dir'], exist_ok=True)
+    # Each job writes its own profile trace next to its output
+    on_event = job['engine_options'].get('on_event')
+    if getattr(on_event, 'trace_path', None) is not None:
+        stem = os.path.splitext(os.path.basename(job['input']))[0]
+        on_event.trace_path = os.path.join(job['output_dir'], stem + '.trace.json')
+    try:
+        if result['format'] == 'BAG':
+            result['output'] = process_bag(job['input'], job['output_dir'], None, None, engine=job['engine'],
+                                           scratch_dir=job['scratch_dir'], summary=summary, **job['engine_options'])
+        else:
+            result['output'] = process_geotiff(job['input'], job['output_dir'], None, None,
+                                               summary=summary, **job['engine_options'], **job['output_options'])
+        result['status'] = 'succeeded'
+    except Exception:
+        result['error'] = traceback.format_exc()
+    finally:
+        shutil.rmtree(job['scratch_dir'], ignore_errors=True)
+    result.update(summary)
+    result['seconds'] = round(time.time() - start, 3)
+    result['peak_memory_mb'] = peak_memory_mb()
+    return result
+
+
+def crashed_job_result(job, error, seconds):
+    # The result of a job whose process died (killed for memory, crashed in
+    # GDAL, ...) before it could report
+    return dict(input=job['input'], format=input_format(job['input']), status='failed', output=None,
+                error=f"The job process died: {error!r}", seconds=round(seconds, 3), peak_memory_mb=None)
+
+
+def plan_jobs(input_files, output_dir, engine='h5py', engine_options=None, output_options=None):
+    # One job per file. Files sharing a name get their own output subdirectory
+    # so their eroded outputs cannot clobber each other; every job gets a
+    # private scratch directory.
+    output_dir = os.path.abspath(output_dir)
+    names = [os.path.splitext(os.path.basename(path))[0].lower() for path in input_files]
+    jobs = []
+    for index, (input_file, name) in enumerate(zip(input_files, names)):
+        job_output_dir = output_dir
+        if names.count(name) > 1:
+            job_output_dir = os.path.join(output_dir, f'job_{index:04d}')
+        jobs.append(dict(
+            input=input_file,
+            output_dir=job_output_dir,
+            scratch_dir=os.path.join(output_dir, '.scratch', f'job_{index:04d}'),
+            engine=engine,
+            engine_options=dict(engine_options or {}),
+            output_options=dict(output_options or {}),
+            ))
+    return jobs
+
+
+def write_summary(summary, summary_path):
+    # Write to a temporary file first so a crash never leaves a truncated summary
+    temporary_path = summary_path + '.tmp'
+    with open(temporary_path, 'w') as summary_file:
+        json.dump(summary, summary_file, indent=2)
+    os.replace(temporary_path, summary_path)
+
+
+def process_batch(inputs, output_dir, jobs=1, recursive=False, summary_path=None, engine='h5py', output_options=None,
+                  **engine_options):
+    # Erode every input file, jobs files at a time. The summary is rewritten
+    # after every finished job, so an interrupted run still leaves a record.
+    # A job whose process dies is recorded as failed and the batch goes on.
+    # output_options (cog, codec, ...) apply to the GeoTIFF outputs.
+    input_files = find_inputs(inputs, recursive)
+    os.makedirs(output_dir, exist_ok=True)
+    if summary_path is None:
+        summary_path = os.path.join(output_dir, 'erosion_summary.json')
+    if engine_options.get('max_memory') is not None:
+        # Jobs run side by side, so each gets its share of the memory budget
+        engine_options['max_memory'] //= max(1, min(jobs, len(input_files)))
+    planned = plan_jobs(input_files, output_dir, engine, engine_options, output_options)
+    print(f"Found {len(planned)} files to erode")
+
+    start = time.time()
+    summary = dict(started=datetime.now().isoformat(timespec='seconds'), output_dir=os.path.abspath(output_dir),
+                   jobs=[], succeeded=0, failed=0)
+    # Every job gets a pool of its own with one fresh spawned process: the
+    # peak memory figures are per job, jobs can start their own chunk worker
+    # pools, and a job process that dies only breaks its own pool
+    context = multiprocessing.get_context('spawn')
+    queued = list(planned)
+    running = {}
+    finished = 0
+    while queued or running:
+        while queued and len(running) < max(1, jobs):
+            job = queued.pop(0)
+            pool = ProcessPoolExecutor(max_workers=1, mp_context=context)
+            running[pool.submit(run_job, job)] = (job, pool, time.time())
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            job, pool, job_start = running.pop(future)
+            try:
+                result = future.result()
+            except Exception as error:
+                result = crashed_job_result(job, error, time.time() - job_start)
+            pool.shutdown()
+            finished += 1
+            summary['jobs'].append(result)
+            summary[result['status']] += 1
+            summary['total_seconds'] = round(time.time() - start, 3)
+            write_summary(summary, summary_path)
+            print(f"Finished {finished} of {len(planned)}: {result['input']} ({result['status']}, {result['seconds']:.1f} s)")
+
+    shutil.rmtree(os.path.join(output_dir, '.scratch'), ignore_errors=True)
+    summary['jobs'].sort(key=lambda job_result: job_result['input'])
+    write_summary(summary, summary_path)
+    print(f"***batch complete: {summary['succeeded']} succeeded, {summary['failed']} failed***")
+    return summary
+
+
+if __name__ == "__main__":
+    import argparse
+    from erode_core import add_engine_arguments, engine_options_from_args
+    from erode_geotiff_functions import add_output_arguments, output_options_from_args
+
+    parser = argparse.ArgumentParser(description='Erode every BAG and GeoTIFF in a set of directories or glob patterns.')
+    parser.add_argument('output_dir', help='The directory to write the eroded files and the run summary to.')
+    parser.add_argument('inputs', nargs='+', help='Input files, directories or glob patterns.')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of files processed at the same time.')
+    parser.add_argument('--recursive', action='store_true', help='Search input directories recursively.')
+    parser.add_argument('--summary', default=None, help='Path of the JSON run summary (default: <output_dir>/erosion_summary.json).')
+    parser.add_argument('--engine', choices=['h5py', 'gdal'], default='h5py', help='BAG engine, see erode_bag_functions.py.')
+    parser.add_argument('--mosaic', action='store_true',
+                        help='Erode the inputs as one seamless mosaic of adjacent tiles, see erode_mosaic.py.')
+    add_engine_arguments(parser)
+    add_output_arguments(parser)
+
+    args = parser.parse_args()
+
+    if args.mosaic:
+        from erode_mosaic import build_mosaic, mosaic_write_bytes, open_mosaic_reader, process_mosaic, with_mosaic_windows
+        input_files = find_inputs(args.inputs, args.recursive)
+        if args.dry_run:
+            from functools import partial
+            from erode_planner import dry_run
+            mosaic = build_mosaic(input_files)
+            dry_run(partial(open_mosaic_reader, mosaic), mosaic.width, mosaic.height, write_bytes=mosaic_write_bytes(mosaic),
+                    **with_mosaic_windows(engine_options_from_args(args)))
+        else:
+            process_mosaic(input_files, args.output_dir, None, None, **engine_options_from_args(args))
+        sys.exit(0)
+
+    if args.dry_run:
+        from erode_bag_functions import bag_write_bytes
+        from erode_io import open_input
+        from erode_planner import dry_run
+        engine_options = engine_options_from_args(args)
+        input_files = find_inputs(args.inputs, args.recursive)
+        if engine_options['max_memory'] is not None:
+            engine_options['max_memory'] //= max(1, min(args.jobs, len(input_files)))
+        for input_file in input_files:
+            print(input_file)
+            write_bytes = bag_write_bytes(input_file) if input_file.lower().endswith(".bag") else 0
+            dry_run(*open_input(input_file)[:3], write_bytes=write_bytes, **engine_options)
+        sys.exit(0)
+
+    process_batch(args.inputs, args.output_dir, jobs=args.jobs, recursive=args.recursive, summary_path=args.summary,
+                  engine=args.engine, output_options=output_options_from_args(args), **engine_options_from_args(args))
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent block cache for re-runs: the pixels erosion drops from a chunk
+depend only on the chunk's nodata mask (halo included), the whole-raster
+size class of the gaps on its edges and the erosion settings. Those are
+hashed into a key, and the chunk's drop mask is kept on disk under it, so
+after a small edit only the chunks whose neighbourhood changed are labelled
+and eroded again; the others take their cached mask and the new depths.
+The seam pass keeps each core's label summary the same way, keyed by the
+core's nodata mask, so unchanged cores are not labelled again either.
+
+@author: Anthony.R.Klemm
+"""
+import hashlib
+import os
+import numpy as np
+
+# Default size bound of a cache directory
+DEFAULT_CACHE_BYTES = 2 * 2**30
+
+# Bumped whenever the meaning of a cached drop mask changes
+CACHE_VERSION = 1
+
+ENTRY_SUFFIX = ".drop"
+SUMMARY_SUFFIX = ".labels"
+
+
+class BlockCache:
+    # Drop masks of eroded chunks in a directory, one bit-packed file per
+    # key, and the seam pass's core label summaries next to them. Hits
+    # refresh a file's modification time, and evict() removes the least
+    # recently used files until the cache fits max_bytes. Entries are
+    # written atomically, so processes and batch jobs can share a cache.
+    def __init__(self, directory, max_bytes=DEFAULT_CACHE_BYTES):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, chunk_data, window, no_data_value, min_gap_size, edge_areas, erode_width):
+        gaps = chunk_data == no_data_value
+        core = (window.start_row - window.buffer_start_row, window.start_col - window.buffer_start_col,
+                window.end_row - window.start_row, window.end_col - window.start_col)
+        digest = hashlib.sha256(repr((CACHE_VERSION, gaps.shape, core, min_gap_size, erode_width,
+                                      edge_areas is None)).encode())
+        digest.update(np.packbits(gaps).tobytes())
+        # Only whether each edge gap is large matters, not its exact area
+        for edge, line_areas in edge_areas or ():
+            digest.update(repr(edge).encode())
+            digest.update(np.packbits((line_areas >= min_gap_size) & gaps[edge]).tobytes())
+        return digest.hexdigest()
+
+    def path(self, key, suffix=ENTRY_SUFFIX):
+        return os.path.join(self.directory, key[:2], key + suffix)
+
+    def get(self, key, shape):
+        # The cached drop mask, or None
+        path = self.path(key)
+        try:
+            packed = np.fromfile(path, dtype=np.uint8)
+            os.utime(path)
+        except OSError:
+            return None
+        size = shape[0] * shape[1]
+        if packed.size != -(-size // 8):
+            return None
+        return np.unpackbits(packed, count=size).reshape(shape).view(bool)
+
+    def put(self, key, drop):
+        self.write(self.path(key), np.packbits(drop))
+
+    def write(self, path, array):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        array.tofile(temporary_path)
+        os.replace(temporary_path, path)
+
+    def summary_key(self, gaps, edge_rows, edge_cols):
+        # A core's label summary depends only on its nodata mask and which of
+        # its rows and columns are buffered edges
+        digest = hashlib.sha256(repr((CACHE_VERSION, "labels", gaps.shape, list(edge_rows), list(edge_cols))).encode())
+        digest.update(np.packbits(gaps).tobytes())
+        return digest.hexdigest()
+
+    def get_summary(self, key, shape, edge_rows, edge_cols):
+        # The cached (areas, lines) of erode_labels.core_label_summary, or None
+        path = self.path(key, SUMMARY_SUFFIX)
+        try:
+            stored = np.fromfile(path, dtype=np.int64)
+            os.utime(path)
+        except OSError:
+            return None
+        rows, cols = shape
+        lengths = [cols, cols, rows, rows] + [cols] * len(edge_rows) + [rows] * len(edge_cols)
+        num_areas = stored.size - sum(lengths)
+        if num_areas < 0:
+            return None
+        return stored[:num_areas], np.split(stored[num_areas:], np.cumsum(lengths)[:-1])
+
+    def put_summary(self, key, summary):
+        areas, lines = summary
+        self.write(self.path(key, SUMMARY_SUFFIX), np.concatenate([areas, *lines]).astype(np.int64))
+
+    def evict(self):
+        # Remove the least recently used entries beyond max_bytes; returns
+        # the number removed
+        entries = []
+        for subdirectory in os.scandir(self.directory):
+            if subdirectory.is_dir():
+                for entry in os.scandir(subdirectory.path):
+                    if entry.name.endswith((ENTRY_SUFFIX, SUMMARY_SUFFIX)):
+                        try:
+                            stat = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
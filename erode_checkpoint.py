@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Checkpoint manifests: durable records of the chunks already written to an
+output, so an interrupted erosion run can resume where it stopped.
+
+@author: Anthony.R.Klemm
+"""
+import json
+import os
+import time
+
+CHECKPOINT_SUFFIX = ".checkpoint.json"
+
+# Seconds between manifest saves; each save flushes the output first
+CHECKPOINT_INTERVAL = 30.0
+
+
+def source_fingerprint(input_file):
+    # A changed source invalidates the checkpoint
+    stat = os.stat(input_file)
+    return dict(path=os.path.abspath(input_file), size=stat.st_size, mtime=stat.st_mtime)
+
+
+def remove_partial_output(output_file):
+    # The output of a cancelled run, and its manifest
+    for path in (output_file, output_file + CHECKPOINT_SUFFIX):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class ChunkCheckpoint:
+    # The manifest next to an output file records which windows are on disk.
+    # Windows are marked as they are written, and the manifest is only saved
+    # after flush() has pushed them to the output, so everything it lists
+    # survives a crash. It is kept after the run, marked complete.
+    def __init__(self, output_file, source, interval=CHECKPOINT_INTERVAL):
+        self.path = output_file + CHECKPOINT_SUFFIX
+        self.output_file = output_file
+        self.source = source
+        self.interval = interval
+        self.flush = None
+        self.settings = None
+        self.done = {}
+        self.complete = False
+        self.saved = {}
+        self.last_save = time.monotonic()
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as manifest_file:
+                    manifest = json.load(manifest_file)
+            except (OSError, ValueError):
+                manifest = {}
+            if manifest.get("source") == source:
+                self.saved = manifest
+
+    def resumable(self):
+        # The existing output can be reused only if it was made from this source
+        return bool(self.saved) and os.path.exists(self.output_file)
+
+    def finished(self):
+        return self.resumable() and self.saved.get("complete", False)
+
+    def reset(self):
+        # The output is being recreated: forget what the manifest says
+        self.saved = {}
+        self.remove()
+
+    def start(self, settings):
+        # Windows written by an earlier run with the same settings, as a
+        # {window index: data pixels written} dict
+        self.settings = settings
+        self.complete = False
+        if self.saved.get("settings") == settings:
+            self.done = {int(index): pixels for index, pixels in self.saved["done"].items()}
+        else:
+            self.done = {}
+        return self.done
+
+    def mark(self, index, pixels_out):
+        # Called once a window has been handed to the output
+        self.done[index] = pixels_out
+        if time.monotonic() - self.last_save >= self.interval:
+            self.save()
+
+    def save(self, complete=False):
+        if self.flush is not None:
+            self.flush()
+        self.complete = complete
+        manifest = dict(source=self.source, settings=self.settings, complete=complete,
+                        done={str(index): pixels for index, pixels in sorted(self.done.items())})
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+        os.replace(temporary_path, self.path)
+        self.saved = manifest
+        self.last_save = time.monotonic()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
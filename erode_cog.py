@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Cloud-optimized GeoTIFF output. Eroded chunks stream into a tiled GeoTIFF
+while its overview pyramid is accumulated from the same chunks, row by row;
+the finished file is then laid out as a COG by GDAL's COG driver, which
+keeps the overviews as they are, and checked with GDAL's COG validator.
+
+@author: Anthony.R.Klemm
+"""
+import contextlib
+import os
+import numpy as np
+from osgeo import gdal
+
+# Codecs for --codec; the LERC family takes a max Z error, the others a
+# floating point predictor
+CODECS = ("DEFLATE", "ZSTD", "LERC", "LERC_DEFLATE", "LERC_ZSTD", "LZW")
+
+# COG tile size; the pyramid stops once an overview fits in one tile
+BLOCK_SIZE = 512
+
+# The chunks stream into this file next to the COG, then it is removed
+STREAM_SUFFIX = ".stream.tif"
+
+
+def creation_options(codec="DEFLATE", max_z_error=None, driver="GTiff"):
+    # Compression options for float32 output from the GTiff or COG driver,
+    # which spell the floating point predictor differently
+    codec = codec.upper()
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec {codec}; use one of {', '.join(CODECS)}")
+    options = ["COMPRESS=" + codec]
+    if codec.startswith("LERC"):
+        if max_z_error is not None:
+            options.append(f"MAX_Z_ERROR={max_z_error}")
+    else:
+        options.append("PREDICTOR=FLOATING_POINT" if driver == "COG" else "PREDICTOR=3")
+    return options
+
+
+def overview_factors(raster_width, raster_height, block_size=BLOCK_SIZE):
+    # Decimation factors 2, 4, 8, ... until the overview fits in one block
+    factors = []
+    factor = 2
+    while -(-max(raster_width, raster_height) // (factor // 2)) > block_size:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def pad_to_pairs(array, row_offset, col_offset):
+    # Zero-pad a 2D array so it starts and ends on even rows and columns of
+    # the grid it sits in at (row_offset, col_offset)
+    top, left = row_offset % 2, col_offset % 2
+    bottom = (top + array.shape[0]) % 2
+    right = (left + array.shape[1]) % 2
+    if top or left or bottom or right:
+        array = np.pad(array, ((top, bottom), (left, right)))
+    return array
+
+
+def sum_pairs(array):
+    # Sum each 2x2 block of an even-sized array
+    rows, cols = array.shape
+    return array.reshape(rows // 2, 2, cols // 2, 2).sum(axis=(1, 3))
+
+
+class OverviewPyramid:
+    # Nodata-aware averages of the eroded raster at factors 2, 4, 8, ...
+    # Every written chunk is summed into level 0 (factor 2); a row of a level
+    # is complete once all the source pixels beneath it have arrived, and is
+    # then handed to write_level(level, array, xoff, yoff) and summed into
+    # the level above. Averages are of all data pixels beneath an overview
+    # pixel, whatever the level, and only incomplete rows are held in memory.
+    def __init__(self, raster_width, raster_height, levels, no_data_value, dtype, write_level):
+        self.raster_width = raster_width
+        self.raster_height = raster_height
+        self.levels = levels
+        self.no_data_value = no_data_value
+        self.dtype = dtype
+        self.write_level = write_level
+        self.widths = [-(-raster_width // 2 ** (level + 1)) for level in range(levels)]
+        self.heights = [-(-raster_height // 2 ** (level + 1)) for level in range(levels)]
+        # Per level, {row: [sums, counts, source pixels arrived]}
+        self.rows = [{} for _ in range(levels)]
+        self.written_rows = [0] * levels
+
+    def complete(self):
+        return all(written == height for written, height in zip(self.written_rows, self.heights))
+
+    def source_pixels(self, level, row):
+        # Source pixels beneath one overview row
+        factor = 2 ** (level + 1)
+        return (min((row + 1) * factor, self.raster_height) - row * factor) * self.raster_width
+
+    def add(self, array, xoff, yoff):
+        # Sum a written chunk into level 0
+        if not self.levels:
+            return
+        data = array != self.no_data_value
+        sums = sum_pairs(pad_to_pairs(np.where(data, array, 0).astype(np.float64), yoff, xoff))
+        counts = sum_pairs(pad_to_pairs(data.astype(np.uint32), yoff, xoff))
+        first_row = yoff // 2
+        source_rows = np.bincount((np.arange(yoff, yoff + array.shape[0]) // 2) - first_row)
+        self.accumulate(0, first_row, xoff // 2, sums, counts, source_rows * array.shape[1])
+
+    def accumulate(self, level, first_row, first_col, sums, counts, arrived):
+        # Add sums and counts whose top-left lands on (first_row, first_col)
+        width = self.widths[level]
+        cols = slice(first_col, first_col + sums.shape[1])
+        for i in range(sums.shape[0]):
+            row = first_row + i
+            entry = self.rows[level].get(row)
+            if entry is None:
+                entry = self.rows[level][row] = [np.zeros(width), np.zeros(width, dtype=np.uint32), 0]
+            entry[0][cols] += sums[i]
+            entry[1][cols] += counts[i]
+            entry[2] += int(arrived[i])
+            if entry[2] == self.source_pixels(level, row):
+                self.finish_row(level, row)
+
+    def finish_row(self, level, row):
+        row_sums, row_counts, arrived = self.rows[level].pop(row)
+        average = np.full(row_sums.shape, self.no_data_value, dtype=self.dtype)
+        has_data = row_counts > 0
+        average[has_data] = row_sums[has_data] / row_counts[has_data]
+        self.write_level(level, average[np.newaxis, :], 0, row)
+        self.written_rows[level] += 1
+        if level + 1 < self.levels:
+            # One row of this level is half a row of the next
+            sums = sum_pairs(pad_to_pairs(row_sums[np.newaxis, :], row, 0))
+            counts = sum_pairs(pad_to_pairs(row_counts[np.newaxis, :], row, 0))
+            self.accumulate(level + 1, row // 2, 0, sums, counts, [arrived])
+
+    def writer(self, write_window):
+        # Wrap write_window so every chunk written also feeds the pyramid
+        def write_and_accumulate(array, xoff, yoff):
+            write_window(array, xoff, yoff)
+            self.add(array, xoff, yoff)
+
+        return write_and_accumulate
+
+
+@contextlib.contextmanager
+def overview_compression():
+    # Internal overviews of the intermediate are compressed like its full
+    # resolution data (GDAL reads this from configuration options)
+    options = dict(COMPRESS_OVERVIEW="DEFLATE", PREDICTOR_OVERVIEW="3")
+    previous = {key: gdal.GetConfigOption(key) for key in options}
+    for key, value in options.items():
+        gdal.SetConfigOption(key, value)
+    try:
+        yield
+    finally:
+        for key, value in previous.items():
+            gdal.SetConfigOption(key, value)
+
+
+def stream_options():
+    # The intermediate is only read once more, by the COG driver: fast,
+    # lossless compression in COG-sized tiles
+    return ["TILED=YES", f"BLOCKXSIZE={BLOCK_SIZE}", f"BLOCKYSIZE={BLOCK_SIZE}", "BIGTIFF=IF_SAFER",
+            "COMPRESS=DEFLATE", "ZLEVEL=1", "PREDICTOR=3"]
+
+
+def add_overview_levels(dataset, factors):
+    # Allocate empty internal overviews ("NONE" resampling computes nothing),
+    # to be filled by an OverviewPyramid
+    with overview_compression():
+        dataset.BuildOverviews("NONE", factors)
+
+
+def overview_writer(band):
+    def write_level(level, array, xoff, yoff):
+        band.GetOverview(level).WriteArray(array, xoff, yoff)
+
+    return write_level
+
+
+def validate_cog(cog_file, factors=()):
+    # Problems that keep a file from being a valid COG, as a list of
+    # messages. GDAL's own validator (osgeo_utils, GDAL 3.2 and later) checks
+    # the IFD and tile layout; without it, the layout GDAL reports when
+    # opening the file, the tiling and the overviews are checked.
+    try:
+        from osgeo_utils.samples.validate_cloud_optimized_geotiff import ValidateCloudOptimizedGeoTIFFException, validate
+    except ImportError:
+        validate = None
+    if validate is not None:
+        try:
+            errors = validate(cog_file, full_check=True)[1]
+        except ValidateCloudOptimizedGeoTIFFException as error:
+            errors = [str(error)]
+        return list(errors)
+    dataset = gdal.Open(cog_file, gdal.GA_ReadOnly)
+    if dataset is None:
+        return [f"{cog_file} cannot be opened: {gdal.GetLastErrorMsg()}"]
+    errors = []
+    if dataset.GetMetadataItem("LAYOUT", "IMAGE_STRUCTURE") != "COG":
+        errors.append("GDAL does not report a COG layout")
+    band = dataset.GetRasterBand(1)
+    if band.GetBlockSize() != [BLOCK_SIZE, BLOCK_SIZE]:
+        errors.append(f"Blocks are {band.GetBlockSize()}, not {BLOCK_SIZE} x {BLOCK_SIZE} tiles")
+    if band.GetOverviewCount() != len(factors):
+        errors.append(f"{band.GetOverviewCount()} overviews instead of {len(factors)}")
+    return errors
+
+
+def finish_cog(stream_file, cog_file, factors, overviews_complete=True, codec="DEFLATE", max_z_error=None):
+    # Lay the closed, streamed file out as a COG with its overviews, then
+    # remove it. A resumed run only streamed part of the raster, so its
+    # pyramid has gaps; the overviews are then computed from the file instead.
+    if factors and not overviews_complete:
+        print("Overviews incomplete after resuming; building them from the eroded raster")
+        stream_dataset = gdal.Open(stream_file, gdal.GA_Update)
+        with overview_compression():
+            stream_dataset.BuildOverviews("AVERAGE", factors)
+        stream_dataset = None
+    stream_dataset = gdal.Open(stream_file, gdal.GA_ReadOnly)
+    options = creation_options(codec, max_z_error, "COG") + [f"BLOCKSIZE={BLOCK_SIZE}", "BIGTIFF=IF_SAFER",
+                                                             "OVERVIEWS=FORCE_USE_EXISTING"]
+    cog_dataset = gdal.GetDriverByName("COG").CreateCopy(cog_file, stream_dataset, options=options)
+    if cog_dataset is None:
+        raise RuntimeError(f"Could not write the COG {cog_file}: {gdal.GetLastErrorMsg()}")
+    cog_dataset = None
+    stream_dataset = None
+    os.remove(stream_file)
+    errors = validate_cog(cog_file, factors)
+    if errors:
+        raise RuntimeError(f"{cog_file} is not a valid COG: " + "; ".join(errors))
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation events of the erosion engine, and an event log that prints
+them, totals the time spent per stage and writes profile traces.
+
+Events are plain dicts passed to an on_event(event) callback. Every event has
+"event" (its kind) and "time" (wall clock seconds):
+  run_start  chunks, pending, raster_width, raster_height
+  pass       name (occupancy or seam), started, seconds
+  chunk      index, chunks, rows, cols, state (mixed, data or nodata), pid,
+             started, stages ({stage: seconds} for read, label, classify,
+             morphology and write, plus cache with a block cache),
+             bytes_read, bytes_written, pixels_in, pixels_out,
+             pixels_removed, peak_memory_mb, and cache (hit or miss) for
+             chunks eroded through a block cache
+  run_end    seconds, chunks, bytes_read, bytes_written, pixels_in,
+             pixels_out, pixels_removed, peak_memory_mb
+  progress   percent (coarse steps of the BAG and GeoTIFF workflows)
+  cancelled  chunks (written before the run stopped), pending
+Chunk events may arrive on the writer thread when the I/O is pipelined.
+
+@author: Anthony.R.Klemm
+"""
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+def peak_memory_mb():
+    # Peak resident memory of this process and its finished child processes
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def emit(on_event, event, **fields):
+    if on_event is not None:
+        fields["event"] = event
+        fields["time"] = time.time()
+        on_event(fields)
+
+
+class ErosionCancelled(Exception):
+    # Raised by erode_raster once its CancelToken is cancelled
+    pass
+
+
+class CancelToken:
+    # Cancelled from any thread (a GUI's Cancel button, a signal handler);
+    # erode_raster checks it between its passes and chunks, finishes the
+    # writes in flight and raises ErosionCancelled
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def check(self):
+        if self.event.is_set():
+            raise ErosionCancelled("Erosion cancelled")
+
+
+class StageLaps:
+    # Adds the time since the previous lap to timings[name]; a no-op without timings
+    def __init__(self, timings):
+        self.timings = timings
+        self.mark = time.perf_counter()
+
+    def lap(self, name):
+        if self.timings is None:
+            return
+        now = time.perf_counter()
+        self.timings[name] = self.timings.get(name, 0.0) + now - self.mark
+        self.mark = now
+
+
+def report_progress(percent, progress=None, root=None, on_event=None):
+    # Coarse workflow progress: an event, a Tk progress bar, or a printed line
+    emit(on_event, "progress", percent=percent)
+    if progress is not None:
+        progress["value"] = percent
+    elif on_event is None:
+        print(f"Progress: {percent}%")
+    if root is not None:
+        root.update_idletasks()
+
+
+class EventLog:
+    # An on_event consumer: prints chunk progress (console), keeps totals per
+    # stage, and with trace_path writes a Chrome trace (chrome://tracing or
+    # https://ui.perfetto.dev) when the run ends. Picklable until first used.
+    def __init__(self, trace_path=None, console=True):
+        self.trace_path = trace_path
+        self.console = console
+        self.events = []
+        self.stage_seconds = {}
+        self.lock = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["lock"] = None
+        return state
+
+    def __call__(self, event):
+        if self.lock is None:
+            self.lock = threading.Lock()
+        if self.console:
+            line = self.describe(event)
+            if line:
+                print(line)
+        with self.lock:
+            self.record(event)
+
+    def record(self, event):
+        if event["event"] == "run_start":
+            self.stage_seconds = {}
+        if event["event"] == "pass":
+            self.stage_seconds[event["name"]] = self.stage_seconds.get(event["name"], 0.0) + event["seconds"]
+        if event["event"] == "chunk":
+            for stage, seconds in event["stages"].items():
+                self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+        if self.trace_path is not None:
+            self.events.append(event)
+            if event["event"] == "run_end":
+                self.write_trace()
+
+    def describe(self, event):
+        if event["event"] == "chunk":
+            stages = ", ".join(f"{stage} {seconds:.2f} s" for stage, seconds in event["stages"].items())
+            state = event["state"] + (", cached" if event.get("cache") == "hit" else "")
+            return (f"Processing chunk {event['index'] + 1} of {event['chunks']} ({state}): {stages}; "
+                    f"{event['pixels_removed']} pixels removed")
+        if event["event"] == "pass":
+            return f"{event['name'].capitalize()} pass: {event['seconds']:.2f} s"
+        if event["event"] == "run_end":
+            return self.summary(event)
+        if event["event"] == "progress":
+            return f"Progress: {event['percent']}%"
+        if event["event"] == "cancelled":
+            return f"Cancelled after {event['chunks']} of {event['pending']} chunks"
+        return None
+
+    def summary(self, run_end):
+        # Where the run spent its time; chunk stages of parallel workers
+        # overlap, so they can add up to more than the wall time
+        total = sum(self.stage_seconds.values()) or 1.0
+        stages = ", ".join(f"{stage} {seconds:.2f} s ({seconds / total:.0%})"
+                           for stage, seconds in sorted(self.stage_seconds.items(), key=lambda item: -item[1]))
+        memory = f", peak memory {run_end['peak_memory_mb']:.0f} MB" if run_end.get("peak_memory_mb") is not None else ""
+        return (f"Eroded {run_end['chunks']} chunks in {run_end['seconds']:.2f} s: "
+                f"{run_end['pixels_removed']} pixels removed, {run_end['bytes_read'] / 1e6:.1f} MB read, "
+                f"{run_end['bytes_written'] / 1e6:.1f} MB written{memory}. Time by stage: {stages}")
+
+    def write_trace(self):
+        # Complete ("X") events per pass and per chunk stage, laid out from
+        # each chunk's start on its process, plus a memory counter track
+        main_pid = os.getpid()
+        trace_events = [dict(name="thread_name", ph="M", pid=main_pid, tid=0, args=dict(name="engine")),
+                        dict(name="thread_name", ph="M", pid=main_pid, tid=2, args=dict(name="writer"))]
+        for event in self.events:
+            if event["event"] == "pass":
+                trace_events.append(dict(name=event["name"], ph="X", pid=main_pid, tid=0,
+                                         ts=event["started"] * 1e6, dur=event["seconds"] * 1e6))
+            elif event["event"] == "chunk":
+                start = event["started"]
+                args = {key: event[key] for key in ("rows", "cols", "state", "bytes_read", "pixels_in", "pixels_removed")}
+                for stage, seconds in event["stages"].items():
+                    if stage == "write":
+                        continue
+                    trace_events.append(dict(name=stage, cat=f"chunk {event['index']}", ph="X", pid=event["pid"],
+                                             tid=1, ts=start * 1e6, dur=seconds * 1e6, args=args))
+                    start += seconds
+                write_seconds = event["stages"].get("write", 0.0)
+                trace_events.append(dict(name="write", cat=f"chunk {event['index']}", ph="X", pid=main_pid, tid=2,
+                                         ts=(event["time"] - write_seconds) * 1e6, dur=write_seconds * 1e6))
+                if event["peak_memory_mb"] is not None:
+                    trace_events.append(dict(name="peak memory (MB)", ph="C", pid=main_pid, ts=event["time"] * 1e6,
+                                             args=dict(mb=round(event["peak_memory_mb"], 1))))
+        with open(self.trace_path, "w") as trace_file:
+            json.dump(dict(traceEvents=trace_events, displayTimeUnit="ms", events=self.events), trace_file)
+        self.events = []
+        if self.console:
+            print(f"Profile trace written to {self.trace_path}")
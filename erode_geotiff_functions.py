@@ -8,170 +8,128 @@ Created on Tue May  2 15:40:29 2023
 import os
 import numpy as np
 from osgeo import gdal
-from skimage import morphology
-from skimage.measure import label, regionprops
-
-
-def prepare_geotiff(input_geotiff, output_dir):
+from erode_checkpoint import ChunkCheckpoint, remove_partial_output, source_fingerprint
+from erode_cog import (CODECS, STREAM_SUFFIX, OverviewPyramid, add_overview_levels, creation_options, finish_cog,
+                       overview_factors, overview_writer, stream_options)
+from erode_core import add_engine_arguments, engine_options_from_args, erode_raster
+from erode_events import ErosionCancelled, report_progress
+from erode_io import create_output_geotiff, open_geotiff_reader, open_input
+from erode_planner import dry_run
+from functools import partial
+
+
+# NoDataValue used for eroded GeoTIFF output; source nodata and NaN are mapped to it
+NO_DATA_VALUE = 1000000
+
+
+def erode_geotiff(input_geotiff, output_dir, chunk_height=1000, overlap_factor=0.1, min_gap_size=6, resume=False,
+                  cog=False, codec=None, max_z_error=None, **engine_options):
+    # The source is read through a normalizing view: each window has its
+    # NoData (and NaN) replaced by NO_DATA_VALUE and is cast to float32 as it
+    # is read, so no temporary copy of the raster is written.
+    # cog writes a cloud-optimized GeoTIFF with overviews averaged from the
+    # chunks as they stream past; codec (see erode_cog.CODECS) compresses the
+    # output with a floating point predictor, max_z_error bounds LERC's loss.
+    # A cancelled run removes its partial output, unless it can be resumed.
     dataset = gdal.Open(input_geotiff, gdal.GA_ReadOnly)
-    band = dataset.GetRasterBand(1)
-
-    # Read raster data
-    raster_data = band.ReadAsArray()
-
-    # Get current NoData value
-    current_nodata_value = band.GetNoDataValue()
-
-    # Set the desired NoData value
-    desired_nodata_value = 1000000
-
-    # Replace current NoData value with desired NoData value
-    if current_nodata_value is not None and not np.isnan(current_nodata_value):
-        raster_data[raster_data == current_nodata_value] = desired_nodata_value
-
-    # If current NoData value is 'nan', also replace 'nan' with desired NoData value
-    if np.isnan(current_nodata_value):
-        raster_data = np.nan_to_num(raster_data, nan=desired_nodata_value)
-
-    # Check the data type of the raster data, convert to float32 if not already
-    if raster_data.dtype != np.float32:
-        raster_data = raster_data.astype(np.float32)
-
-    # Create a new GeoTIFF file
-    driver = gdal.GetDriverByName('GTiff')
-    out_dataset = driver.Create(output_dir +'/'+ 'temp.tif', dataset.RasterXSize, dataset.RasterYSize, 1, gdal.GDT_Float32)
-    out_dataset.SetGeoTransform(dataset.GetGeoTransform())
-    out_dataset.SetProjection(dataset.GetProjection())
-
-    # Write the processed data to the new file
-    out_band = out_dataset.GetRasterBand(1)
-    out_band.WriteArray(raster_data)
-    out_band.SetNoDataValue(desired_nodata_value)
-
-    # Clean up
-    out_band.FlushCache()
-    out_band = None
-    out_dataset = None
-    dataset = None
-
-    full_elevation_tiff = output_dir +'/'+ 'temp.tif'
-    return full_elevation_tiff
-
-
-def erode_geotiff(input_geotiff, output_dir, chunk_height=1000, overlap_factor=0.1, min_gap_size=6):
-    full_elevation_tiff = prepare_geotiff(input_geotiff, output_dir)
-    dataset = gdal.Open(full_elevation_tiff)
-    band = dataset.GetRasterBand(1)
     
     raster_width = dataset.RasterXSize
     raster_height = dataset.RasterYSize
-    no_data_value = dataset.GetRasterBand(1).GetNoDataValue()
     
+    # Stream each eroded chunk straight into a tiled, compressed output TIFF
+    eroded_geotiff_file = os.path.join(output_dir, os.path.splitext(os.path.basename(input_geotiff))[0] + "_eroded" + os.path.splitext(input_geotiff)[1])
     
-    # Resultant array to store the eroded data
-    eroded_data = np.full((raster_height, raster_width), no_data_value)
+    # With resume, a partial output left by an interrupted run of the same
+    # source is reopened and only the chunks missing from its checkpoint are written
+    checkpoint = ChunkCheckpoint(eroded_geotiff_file, source_fingerprint(input_geotiff))
+    if resume and checkpoint.finished():
+        print(f"***{eroded_geotiff_file} was already completed, skipping***")
+        return eroded_geotiff_file
     
-    # Calculate the number of chunks
-    overlap_pixels = int(chunk_height * overlap_factor)
-    num_chunks = max(1, ((raster_height - overlap_pixels - 1) // (chunk_height - overlap_pixels)) + 1)
-    print(f"Number of chunks: {num_chunks}")
+    # A COG is laid out in one go once the raster is complete, so its chunks
+    # first stream into a tiled GeoTIFF next to it, with its own checkpoint
+    stream_file = eroded_geotiff_file + STREAM_SUFFIX if cog else eroded_geotiff_file
+    stream_checkpoint = ChunkCheckpoint(stream_file, source_fingerprint(input_geotiff)) if cog else checkpoint
+    factors = overview_factors(raster_width, raster_height) if cog else []
+    eroded_dataset = None
+    if resume and stream_checkpoint.resumable():
+        # A file killed mid-write may no longer open; it is then started again
+        try:
+            eroded_dataset = gdal.Open(stream_file, gdal.GA_Update)
+        except RuntimeError:
+            eroded_dataset = None
+        if eroded_dataset is None:
+            print(f"***{stream_file} cannot be opened, starting it again***")
+    if eroded_dataset is None:
+        # A stale manifest must not vouch for the new file
+        checkpoint.reset()
+        stream_checkpoint.reset()
+        options = None
+        if cog:
+            options = stream_options()
+        elif codec is not None:
+            options = ["TILED=YES", "BIGTIFF=IF_SAFER"] + creation_options(codec, max_z_error)
+        eroded_dataset = create_output_geotiff(stream_file, dataset, gdal.GDT_Float32, NO_DATA_VALUE, options)
+        if factors:
+            add_overview_levels(eroded_dataset, factors)
+    eroded_band = eroded_dataset.GetRasterBand(1)
+    stream_checkpoint.flush = eroded_dataset.FlushCache
     
-    # Iterate over the raster in chunks
-    for i, start_row in enumerate(range(0, raster_height, chunk_height - overlap_pixels)):
-        if start_row >= raster_height:
-            break
-        end_row = min(start_row + chunk_height, raster_height)
-        print(f"Processing chunk {i + 1} of {num_chunks}...")
-        
-        # Read the chunk data with buffer
-        buffer_size = overlap_pixels
-        buffer_start_row = max(0, start_row - buffer_size)
-        buffer_end_row = min(raster_height, end_row + buffer_size)
-        chunk_data = band.ReadAsArray(0, buffer_start_row, raster_width, buffer_end_row - buffer_start_row)
-        
-        # Create a binary mask based on the NoDataValue
-        binary_mask = np.where(chunk_data != no_data_value, 1, 0).astype(np.uint8)
-
-        # Invert binary mask to focus on gaps
-        inverted_binary_mask = np.where(binary_mask == 0, 1, 0).astype(np.uint8)
-
-        # Label connected components in the inverted binary mask
-        labeled_mask = label(inverted_binary_mask)
-
-        # Create masks for small and large gaps
-        small_gaps_mask = np.zeros_like(binary_mask)
-        large_gaps_mask = np.zeros_like(binary_mask)
-
-        for region in regionprops(labeled_mask):
-            region_mask = (labeled_mask == region.label)
-            if region.area < min_gap_size:
-                small_gaps_mask[region_mask] = 1
-            else:
-                large_gaps_mask[region_mask] = 1
-        
-        # Dilate large gaps
-        dilated_large_gaps_mask = morphology.binary_dilation(large_gaps_mask, morphology.square(5))
-
-        # Erode all edges, including gaps
-        eroded_mask = morphology.binary_erosion(binary_mask, morphology.square(3))
-
-        # Add back in data values from dilated large gaps mask and small gaps mask
-        eroded_chunk = np.where(eroded_mask == 1, chunk_data, no_data_value)
-        eroded_chunk[~dilated_large_gaps_mask & (eroded_mask == 0)] = chunk_data[~dilated_large_gaps_mask & (eroded_mask == 0)]
-        eroded_chunk[small_gaps_mask == 1] = chunk_data[small_gaps_mask == 1]
-        
-        # Remove buffer
-        buffer_rows_to_remove = buffer_size if start_row != 0 else 0
-        final_eroded_chunk = eroded_chunk[buffer_rows_to_remove : buffer_rows_to_remove + (end_row - start_row), :]
-        
-        # Store the eroded chunk data in the resultant array
-        eroded_data[start_row:end_row, :] = final_eroded_chunk
+    write_window = eroded_band.WriteArray
+    if cog:
+        pyramid = OverviewPyramid(raster_width, raster_height, len(factors), NO_DATA_VALUE, np.float32,
+                                  overview_writer(eroded_band))
+        write_window = pyramid.writer(write_window)
     
-    # Save the eroded data as a TIFF (this can be modified based on requirements)
-    driver = gdal.GetDriverByName('GTiff')
-    options = ["COMPRESS=LZW"]
-    eroded_dataset = driver.Create(
-        os.path.join(output_dir, os.path.splitext(os.path.basename(input_geotiff))[0] + "_eroded" + os.path.splitext(input_geotiff)[1]),
-        raster_width,
-        raster_height,
-        1,
-        band.DataType,
-        options=options
-        )
-    eroded_dataset.SetGeoTransform(dataset.GetGeoTransform())
-    eroded_dataset.SetProjection(dataset.GetProjection())
-    eroded_band = eroded_dataset.GetRasterBand(1)
-    eroded_band.WriteArray(eroded_data)
-    eroded_band.SetNoDataValue(no_data_value)
+    try:
+        erode_raster(partial(open_geotiff_reader, input_geotiff, NO_DATA_VALUE), write_window, raster_width, raster_height, NO_DATA_VALUE,
+                     chunk_height, overlap_factor, min_gap_size, checkpoint=stream_checkpoint if resume else None, **engine_options)
+    except ErosionCancelled:
+        # Close the output before removing it
+        eroded_band.FlushCache()
+        write_window = pyramid = eroded_band = eroded_dataset = stream_checkpoint.flush = None
+        if not resume:
+            remove_partial_output(stream_file)
+        raise
     eroded_band.FlushCache()
 
     # Cleanup
     dataset = None
+    eroded_band = None
     eroded_dataset = None
+    
+    if cog:
+        print('Writing cloud-optimized GeoTIFF...')
+        finish_cog(stream_file, eroded_geotiff_file, factors, pyramid.complete(), codec or "DEFLATE", max_z_error)
+        if resume:
+            # The streamed file is gone: the COG's own manifest marks it done
+            checkpoint.settings, checkpoint.done = stream_checkpoint.settings, stream_checkpoint.done
+            checkpoint.save(complete=True)
+            stream_checkpoint.remove()
     print('***elevation band erosion complete***')
-    return output_dir + '/eroded.tif'
+    return eroded_geotiff_file
 
 
-def remove_intermediate_files(output_dir):
-    print('***removing intermediate files***')
-    full_elevation_tiff = output_dir +'/'+ 'temp.tif'
-    os.remove(full_elevation_tiff)
+def add_output_arguments(parser):
+    # GeoTIFF output options, shared with the batch script
+    parser.add_argument('--cog', action='store_true',
+                        help='Write a cloud-optimized GeoTIFF with overviews built while the chunks are written.')
+    parser.add_argument('--codec', type=str.upper, choices=CODECS, default=None,
+                        help='Output compression, with a floating point predictor (default LZW, or DEFLATE with --cog).')
+    parser.add_argument('--max-z-error', type=float, default=None,
+                        help='Largest error LERC codecs may introduce, in depth units (default lossless).')
 
 
-def process_geotiff(input_geotiff, output_dir, progress, root):
-    eroded_geotiff_file = os.path.join(output_dir, os.path.splitext(os.path.basename(input_geotiff))[0] + "_eroded" + os.path.splitext(input_geotiff)[1])
-    prepare_geotiff(input_geotiff, output_dir)
-    if progress is not None: progress["value"] = 25
-    else: print("Progress: 25%")
-    if root is not None: root.update_idletasks()
-    erode_geotiff(input_geotiff, output_dir)
-    if progress is not None: progress["value"] = 50
-    else: print("Progress: 50%")
-    if root is not None: root.update_idletasks()
-    remove_intermediate_files(output_dir)
-    if progress is not None: progress["value"] = 100
-    else: print("Progress: 100%")
-    if root is not None: root.update_idletasks()
+def output_options_from_args(args):
+    return dict(cog=args.cog, codec=args.codec, max_z_error=args.max_z_error)
+
+
+def process_geotiff(input_geotiff, output_dir, progress, root, **engine_options):
+    # engine_options (workers, tile_size, kernel, on_event, ...) are passed through to erode_core.erode_raster
+    on_event = engine_options.get("on_event")
+    report_progress(25, progress, root, on_event)
+    eroded_geotiff_file = erode_geotiff(input_geotiff, output_dir, **engine_options)
+    report_progress(100, progress, root, on_event)
     return eroded_geotiff_file
 
 
@@ -181,9 +139,16 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Process a geotiff file to erode its outer edges.')
     parser.add_argument('input_geotiff', help='The path to the input geotiff file.')
     parser.add_argument('output_dir', help='The output directory of the processed geotiff file.')
+    add_engine_arguments(parser)
+    add_output_arguments(parser)
     
     args = parser.parse_args()
     
+    if args.dry_run:
+        # Show the chunk plan and its predicted memory, without eroding
+        dry_run(*open_input(args.input_geotiff)[:3], **engine_options_from_args(args))
+        raise SystemExit
+    
     # Call the process_geotiff function with the input arguments.
-    process_geotiff(args.input_geotiff, args.output_dir, None, None)
+    process_geotiff(args.input_geotiff, args.output_dir, None, None, **engine_options_from_args(args), **output_options_from_args(args))
 
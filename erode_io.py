@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Windowed raster readers and writers used by the chunked erosion engine.
+
+@author: Anthony.R.Klemm
+"""
+import numpy as np
+from osgeo import gdal
+import h5py
+from functools import partial
+
+
+def open_geotiff_reader(input_geotiff, no_data_value=None):
+    # Open a private GDAL handle; the closure keeps the dataset alive.
+    # With no_data_value, windows are normalized as they are read: the band's
+    # NoData (and NaN, when NoData is NaN or unset) becomes no_data_value and
+    # the data is cast to float32.
+    dataset = gdal.Open(input_geotiff, gdal.GA_ReadOnly)
+    band = dataset.GetRasterBand(1)
+    source_no_data_value = band.GetNoDataValue()
+
+    def read_window(xoff, yoff, xsize, ysize):
+        data = band.ReadAsArray(xoff, yoff, xsize, ysize)
+        if no_data_value is None:
+            return data
+        if source_no_data_value is None or np.isnan(source_no_data_value):
+            no_data_mask = np.isnan(data) if np.issubdtype(data.dtype, np.floating) else None
+        else:
+            no_data_mask = data == source_no_data_value
+        data = data.astype(np.float32, copy=False)
+        if no_data_mask is not None:
+            data[no_data_mask] = no_data_value
+        return data
+
+    block_width, block_height = band.GetBlockSize()
+    read_window.block_shape = (block_height, block_width)
+    read_window.dataset = dataset
+    return read_window
+
+
+def open_bag_reader(input_bag, layer="elevation"):
+    # Open a private h5py handle on one /BAG_root grid
+    bag = h5py.File(input_bag, "r")
+    read_window = bag_window_reader(bag["/BAG_root/" + layer])
+    read_window.bag = bag
+    return read_window
+
+
+def create_output_geotiff(output_path, like_dataset, data_type, no_data_value, options=None):
+    # Tiled, compressed GeoTIFF that chunks are streamed into window by window
+    driver = gdal.GetDriverByName('GTiff')
+    if options is None:
+        options = ["COMPRESS=LZW", "TILED=YES", "BIGTIFF=IF_SAFER"]
+    out_dataset = driver.Create(
+        output_path,
+        like_dataset.RasterXSize,
+        like_dataset.RasterYSize,
+        1,
+        data_type,
+        options=options
+        )
+    out_dataset.SetGeoTransform(like_dataset.GetGeoTransform())
+    out_dataset.SetProjection(like_dataset.GetProjection())
+    out_dataset.GetRasterBand(1).SetNoDataValue(no_data_value)
+    return out_dataset
+
+
+def bag_window_writer(bag_dataset):
+    # BAG grids are stored south-up, GDAL windows are north-up: map the window
+    # rows onto the flipped hyperslab and write a reversed view (no copy)
+    raster_height = bag_dataset.shape[0]
+
+    def write_window(array, xoff, yoff):
+        rows, cols = array.shape
+        bag_dataset[raster_height - yoff - rows : raster_height - yoff, xoff : xoff + cols] = array[::-1]
+
+    return write_window
+
+
+def bag_window_reader(bag_dataset):
+    # Read the north-up window as a flipped hyperslab and return a reversed view
+    raster_height = bag_dataset.shape[0]
+
+    def read_window(xoff, yoff, xsize, ysize):
+        return bag_dataset[raster_height - yoff - ysize : raster_height - yoff, xoff : xoff + xsize][::-1]
+
+    # HDF5 chunks count from the bottom row, so their edges sit at
+    # raster_height % chunk_rows in north-up rows
+    if bag_dataset.chunks is not None:
+        read_window.block_shape = bag_dataset.chunks
+        read_window.block_row_origin = raster_height % bag_dataset.chunks[0]
+    return read_window
+
+
+def open_input(input_file):
+    # Picklable open_reader, size and nodata value of a BAG or GeoTIFF, read
+    # as the workflows read them
+    if input_file.lower().endswith(".bag"):
+        from erode_bag_functions import BAG_NO_DATA_VALUE
+        with h5py.File(input_file, "r") as bag:
+            raster_height, raster_width = bag["/BAG_root/elevation"].shape
+        return partial(open_bag_reader, input_file, "elevation"), raster_width, raster_height, BAG_NO_DATA_VALUE
+    from erode_geotiff_functions import NO_DATA_VALUE as GEOTIFF_NO_DATA_VALUE
+    open_reader = partial(open_geotiff_reader, input_file, GEOTIFF_NO_DATA_VALUE)
+    dataset = open_reader().dataset
+    return open_reader, dataset.RasterXSize, dataset.RasterYSize, GEOTIFF_NO_DATA_VALUE
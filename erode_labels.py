@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming gap labeller: sizes every gap over the whole raster so that gaps
+crossing chunk or tile seams are classified by their true area.
+
+@author: Anthony.R.Klemm
+"""
+import numpy as np
+from skimage.measure import label
+
+
+class GapUnionFind:
+    # Union-find over global gap label ids. Only labels that meet a seam get
+    # an entry, every other label is its own root.
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, x):
+        root = x
+        while self.parent.get(root, root) != root:
+            root = self.parent[root]
+        while x != root:
+            next_x = self.parent.get(x, x)
+            self.parent[x] = root
+            x = next_x
+        return root
+
+    def union(self, a, b):
+        root_a = self.find(a)
+        root_b = self.find(b)
+        if root_a != root_b:
+            self.parent[max(root_a, root_b)] = min(root_a, root_b)
+
+
+def seam_pairs(above, below):
+    # Unique (above, below) label pairs that touch across a seam (8-connectivity)
+    pairs = []
+    for a, b in ((above, below), (above[:-1], below[1:]), (above[1:], below[:-1])):
+        touching = (a > 0) & (b > 0)
+        pairs.append(np.stack([a[touching], b[touching]], axis=1))
+    return np.unique(np.concatenate(pairs), axis=0)
+
+
+def core_label_summary(gaps, edge_rows=(), edge_cols=()):
+    # What the seam pass needs of a labelled core: the area of every gap that
+    # meets the core's border or one of the given row and column offsets
+    # (numbered 1..n), and the labels along the top, bottom, left and right
+    # border, then those rows and columns (0 where there is no such gap)
+    labeled_tile = label(gaps)
+    lines = [labeled_tile[0], labeled_tile[-1], labeled_tile[:, 0], labeled_tile[:, -1]]
+    lines += [labeled_tile[row] for row in edge_rows]
+    lines += [labeled_tile[:, col] for col in edge_cols]
+    kept = np.unique(np.concatenate(lines))
+    kept = kept[kept > 0]
+    areas = np.bincount(labeled_tile.ravel(), minlength=int(labeled_tile.max()) + 1)[kept]
+    local_labels = np.zeros(int(labeled_tile.max()) + 1, dtype=np.int64)
+    local_labels[kept] = np.arange(1, kept.size + 1)
+    return areas.astype(np.int64), [local_labels[line] for line in lines]
+
+
+def seam_gap_areas(read_window, windows, raster_width, raster_height, no_data_value, occupancy=None, cancel=None,
+                   cache=None):
+    # First pass: label the core of every window (row-major order), merge the
+    # labels across each seam and total the area of every global gap. Only
+    # gaps on a core's border or on a buffered edge get a global label, so
+    # memory grows with the length of the seams, not the number of gaps.
+    # Returns, per window, a list of (edge index, global gap area of every
+    # pixel on that edge) for the buffered chunk's edges that lie inside the
+    # raster. An empty occupancy index from
+    # erode_occupancy.core_occupancy_index is filled in from the same core
+    # reads, so the raster is not read again to build it. cache, an
+    # erode_cache.BlockCache, keeps every core's label summary, so cores
+    # whose nodata mask is unchanged since an earlier run are not labelled.
+    # cancel, an erode_events.CancelToken, is checked before every window.
+    edge_rows = {}
+    edge_cols = {}
+    for window in windows:
+        if window.buffer_start_row > 0:
+            edge_rows[window.buffer_start_row] = None
+        if window.buffer_end_row < raster_height:
+            edge_rows[window.buffer_end_row - 1] = None
+        if window.buffer_start_col > 0:
+            edge_cols[window.buffer_start_col] = None
+        if window.buffer_end_col < raster_width:
+            edge_cols[window.buffer_end_col - 1] = None
+    for row in edge_rows:
+        edge_rows[row] = np.zeros(raster_width, dtype=np.int64)
+    for col in edge_cols:
+        edge_cols[col] = np.zeros(raster_height, dtype=np.int64)
+
+    union_find = GapUnionFind()
+    tile_areas = [np.zeros(1, dtype=np.int64)]
+    label_offset = 0
+    previous_band_bottom = None
+    band_top = band_bottom = None
+    band_start_row = None
+    left_col = None
+    for window in windows:
+        if cancel is not None:
+            cancel.check()
+        # A new band of tiles: merge the finished band with the one above it
+        if window.start_row != band_start_row:
+            if band_top is not None and previous_band_bottom is not None:
+                for a, b in seam_pairs(previous_band_bottom, band_top):
+                    union_find.union(int(a), int(b))
+            previous_band_bottom = band_bottom
+            band_top = np.zeros(raster_width, dtype=np.int64)
+            band_bottom = np.zeros(raster_width, dtype=np.int64)
+            band_start_row = window.start_row
+            left_col = None
+
+        tile = read_window(window.start_col, window.start_row, window.end_col - window.start_col, window.end_row - window.start_row)
+        gaps = tile == no_data_value
+        if occupancy is not None:
+            occupancy.record(window.start_row, window.start_col, gaps, tile.dtype)
+        tile_edge_rows = [row for row in edge_rows if window.start_row <= row < window.end_row]
+        tile_edge_cols = [col for col in edge_cols if window.start_col <= col < window.end_col]
+        offsets = ([row - window.start_row for row in tile_edge_rows], [col - window.start_col for col in tile_edge_cols])
+        summary = None
+        if cache is not None:
+            key = cache.summary_key(gaps, *offsets)
+            summary = cache.get_summary(key, gaps.shape, *offsets)
+        if summary is None:
+            summary = core_label_summary(gaps, *offsets)
+            if cache is not None:
+                cache.put_summary(key, summary)
+
+        # Number the gaps that can meet a seam or an edge in the global id
+        # space; gaps wholly inside the core are dropped (0)
+        areas, lines = summary
+        tile_areas.append(areas)
+        lines = [np.where(line > 0, line + label_offset, 0) for line in lines]
+        top, bottom, first_col, last_col = lines[:4]
+
+        # Merge with the tile to the left
+        if left_col is not None:
+            for a, b in seam_pairs(left_col, first_col):
+                union_find.union(int(a), int(b))
+        left_col = last_col
+        band_top[window.start_col : window.end_col] = top
+        band_bottom[window.start_col : window.end_col] = bottom
+
+        for row, line in zip(tile_edge_rows, lines[4:]):
+            edge_rows[row][window.start_col : window.end_col] = line
+        for col, line in zip(tile_edge_cols, lines[4 + len(tile_edge_rows):]):
+            edge_cols[col][window.start_row : window.end_row] = line
+        label_offset += areas.size
+
+    if band_top is not None and previous_band_bottom is not None:
+        for a, b in seam_pairs(previous_band_bottom, band_top):
+            union_find.union(int(a), int(b))
+
+    # Resolve every label to its root and total the component areas
+    roots = np.arange(label_offset + 1)
+    for global_label in list(union_find.parent):
+        roots[global_label] = union_find.find(global_label)
+    component_areas = np.bincount(roots, weights=np.concatenate(tile_areas), minlength=label_offset + 1).astype(np.int64)
+
+    window_edge_areas = []
+    for window in windows:
+        rows = slice(window.buffer_start_row, window.buffer_end_row)
+        cols = slice(window.buffer_start_col, window.buffer_end_col)
+        edge_areas = []
+        if window.buffer_start_row > 0:
+            edge_areas.append(((0, slice(None)), component_areas[roots[edge_rows[window.buffer_start_row][cols]]]))
+        if window.buffer_end_row < raster_height:
+            edge_areas.append(((-1, slice(None)), component_areas[roots[edge_rows[window.buffer_end_row - 1][cols]]]))
+        if window.buffer_start_col > 0:
+            edge_areas.append(((slice(None), 0), component_areas[roots[edge_cols[window.buffer_start_col][rows]]]))
+        if window.buffer_end_col < raster_width:
+            edge_areas.append(((slice(None), -1), component_areas[roots[edge_cols[window.buffer_end_col - 1][rows]]]))
+        window_edge_areas.append(edge_areas)
+    return window_edge_areas
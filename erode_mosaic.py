@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+Mosaic mode: erode a set of adjacent survey tiles (BAG and/or GeoTIFF) as one
+virtual raster, so gaps straddling tile boundaries are sized as a whole and
+tile edges are not taken for gap edges. The chunked engine runs over a mosaic
+index of the tiles; every eroded window is split back among the tiles it
+covers and written into each tile's own eroded copy.
+
+@author: Anthony.R.Klemm
+"""
+import math
+import os
+import re
+from collections import OrderedDict, namedtuple
+from functools import partial
+import numpy as np
+from osgeo import gdal
+import h5py
+from erode_bag_functions import BAG_NO_DATA_VALUE, bag_write_bytes, masked_layers_writer, start_bag_copy
+from erode_core import erode_raster
+from erode_checkpoint import remove_partial_output
+from erode_events import ErosionCancelled, report_progress
+from erode_geotiff_functions import NO_DATA_VALUE
+from erode_io import create_output_geotiff, open_bag_reader, open_geotiff_reader
+
+# A tile's place in the mosaic grid, in pixels
+MosaicTile = namedtuple("MosaicTile", "path col_offset row_offset width height")
+Mosaic = namedtuple("Mosaic", "tiles width height geotransform")
+
+# Largest misalignment with the mosaic grid, in pixels, taken as rounding
+ALIGNMENT_TOLERANCE = 1e-3
+
+# Tile readers kept open at a time; the least recently read is closed first
+MAX_OPEN_TILES = 64
+
+# A mosaic is usually far wider than a tile, so full-width strips would hold
+# a whole row of tiles: windows of about this many pixels are used instead,
+# unless a tile size or memory budget is given
+MOSAIC_TILE_SIZE = 2048
+
+
+def is_bag(path):
+    return path.lower().endswith(".bag")
+
+
+def bag_geotransform(input_bag):
+    # North-up geotransform of a BAG from its metadata corner points, which
+    # are the centres of the south-west and north-east cells
+    with h5py.File(input_bag, "r") as bag:
+        raster_height, raster_width = bag["/BAG_root/elevation"].shape
+        metadata = bag["/BAG_root/metadata"][()].tobytes().decode("utf-8", "replace")
+    match = re.search(r"<gml:coordinates[^>]*>\s*([^<]+?)\s*</gml:coordinates>", metadata)
+    if match is None:
+        raise ValueError(f"No corner points in the metadata of {input_bag}")
+    (west, south), (east, north) = [[float(value) for value in point.split(",")[:2]] for point in match.group(1).split()]
+    if raster_width < 2 or raster_height < 2:
+        raise ValueError(f"Cannot derive the resolution of {input_bag} from its corner points")
+    x_resolution = (east - west) / (raster_width - 1)
+    y_resolution = (north - south) / (raster_height - 1)
+    return (west - x_resolution / 2, x_resolution, 0.0, north + y_resolution / 2, 0.0, -y_resolution), raster_width, raster_height
+
+
+def raster_geotransform(input_file):
+    # (geotransform, width, height) of a BAG or GeoTIFF
+    if is_bag(input_file):
+        return bag_geotransform(input_file)
+    dataset = gdal.Open(input_file, gdal.GA_ReadOnly)
+    return dataset.GetGeoTransform(), dataset.RasterXSize, dataset.RasterYSize
+
+
+def build_mosaic(input_files):
+    # Place the tiles on one grid. They must share a north-up grid (same
+    # resolution, offsets a whole number of pixels apart) and a coordinate
+    # system, which is not checked.
+    if not input_files:
+        raise ValueError("A mosaic needs at least one input tile")
+    placed = [(path,) + raster_geotransform(path) for path in input_files]
+    x_resolution, y_resolution = placed[0][1][1], placed[0][1][5]
+    for path, geotransform, _, _ in placed:
+        if geotransform[2] or geotransform[4] or geotransform[5] >= 0:
+            raise ValueError(f"{path} is not north-up")
+        if not (math.isclose(geotransform[1], x_resolution, rel_tol=1e-6) and math.isclose(geotransform[5], y_resolution, rel_tol=1e-6)):
+            raise ValueError(f"{path} has a resolution of {geotransform[1]} x {-geotransform[5]}, "
+                             f"not {x_resolution} x {-y_resolution} like {placed[0][0]}")
+    left = min(geotransform[0] for _, geotransform, _, _ in placed)
+    top = max(geotransform[3] for _, geotransform, _, _ in placed)
+
+    tiles = []
+    for path, geotransform, width, height in placed:
+        col_offset = (geotransform[0] - left) / x_resolution
+        row_offset = (geotransform[3] - top) / y_resolution
+        if max(abs(col_offset - round(col_offset)), abs(row_offset - round(row_offset))) > ALIGNMENT_TOLERANCE:
+            raise ValueError(f"{path} is not aligned with the grid of {placed[0][0]}")
+        tiles.append(MosaicTile(path, int(round(col_offset)), int(round(row_offset)), width, height))
+    mosaic_width = max(tile.col_offset + tile.width for tile in tiles)
+    mosaic_height = max(tile.row_offset + tile.height for tile in tiles)
+    return Mosaic(tuple(tiles), mosaic_width, mosaic_height, (left, x_resolution, 0.0, top, 0.0, y_resolution))
+
+
+def overlapping_tiles(tiles, xoff, yoff, xsize, ysize):
+    # (tile, slices of the mosaic window, (xoff, yoff, xsize, ysize) in the
+    # tile) for every tile under a mosaic window
+    for tile in tiles:
+        start_col, end_col = max(xoff, tile.col_offset), min(xoff + xsize, tile.col_offset + tile.width)
+        start_row, end_row = max(yoff, tile.row_offset), min(yoff + ysize, tile.row_offset + tile.height)
+        if start_col < end_col and start_row < end_row:
+            window = (slice(start_row - yoff, end_row - yoff), slice(start_col - xoff, end_col - xoff))
+            yield tile, window, (start_col - tile.col_offset, start_row - tile.row_offset, end_col - start_col, end_row - start_row)
+
+
+def open_tile_reader(path):
+    # Tiles are read as the BAG and GeoTIFF workflows read them: float32 with
+    # a NoDataValue of 1000000 either way
+    if is_bag(path):
+        return open_bag_reader(path, "elevation")
+    return open_geotiff_reader(path, NO_DATA_VALUE)
+
+
+def open_mosaic_reader(mosaic):
+    # read_window over the mosaic: each window is assembled from the tiles
+    # under it, with nodata where there is no tile. Where tiles overlap, the
+    # first tile (in input order) with data supplies the pixel.
+    readers = OrderedDict()
+
+    def tile_reader(tile):
+        if tile.path in readers:
+            readers.move_to_end(tile.path)
+        else:
+            readers[tile.path] = open_tile_reader(tile.path)
+            if len(readers) > MAX_OPEN_TILES:
+                readers.popitem(last=False)
+        return readers[tile.path]
+
+    def read_window(xoff, yoff, xsize, ysize):
+        data = np.full((ysize, xsize), BAG_NO_DATA_VALUE, dtype=np.float32)
+        for tile, window, tile_window in overlapping_tiles(mosaic.tiles, xoff, yoff, xsize, ysize):
+            target = data[window]
+            np.copyto(target, tile_reader(tile)(*tile_window), where=target == BAG_NO_DATA_VALUE)
+        return data
+
+    return read_window
+
+
+def eroded_tile_path(tile, output_dir):
+    stem, extension = os.path.splitext(os.path.basename(tile.path))
+    return os.path.join(output_dir, stem + "_eroded" + extension)
+
+
+def overlapped_tiles(tiles):
+    # Paths of the tiles that overlap another tile
+    return {tile.path for tile in tiles
+            if any(other is not tile for other, _, _ in overlapping_tiles(
+                tiles, tile.col_offset, tile.row_offset, tile.width, tile.height))}
+
+
+def mosaic_write_bytes(mosaic):
+    # Bytes per pixel MosaicWriter allocates, for the memory planner: the BAG
+    # tiles' masked layers, plus a tile's own depths and their masked copy
+    # where tiles overlap
+    layers = max((bag_write_bytes(tile.path) for tile in mosaic.tiles if is_bag(tile.path)), default=0)
+    return layers + (8 if overlapped_tiles(mosaic.tiles) else 0)
+
+
+class MosaicWriter:
+    # write_window for the mosaic: splits each eroded window among the tiles
+    # under it. A tile's eroded copy is created on its first window and
+    # closed as soon as all of its pixels are written, so only the outputs of
+    # the tiles under the active windows are open. BAG tiles get every
+    # gridded layer masked (erode_bag_functions.masked_layers_writer).
+    # The eroded mosaic holds the first tile's depths where tiles overlap, so
+    # a tile that overlaps another gets its own depths back wherever the
+    # mosaic keeps a pixel, read from the tile alongside the window.
+    def __init__(self, mosaic, output_dir):
+        self.tiles = mosaic.tiles
+        self.output_dir = output_dir
+        self.outputs = [eroded_tile_path(tile, output_dir) for tile in self.tiles]
+        duplicates = {path for path in self.outputs if self.outputs.count(path) > 1}
+        if duplicates:
+            raise ValueError(f"Tiles would share the outputs {', '.join(sorted(duplicates))}; rename them first")
+        self.remaining = {tile.path: tile.width * tile.height for tile in self.tiles}
+        self.open_outputs = {}
+        self.created = []
+        self.overlapped = overlapped_tiles(self.tiles)
+        self.bytes_per_pixel = mosaic_write_bytes(mosaic)
+
+    def open_output(self, tile):
+        eroded_file = eroded_tile_path(tile, self.output_dir)
+        self.created.append(eroded_file)
+        if is_bag(tile.path):
+            start_bag_copy(tile.path, eroded_file)
+            source = h5py.File(tile.path, "r")
+            bag = h5py.File(eroded_file, "r+")
+
+            def close():
+                bag.close()
+                source.close()
+
+            return masked_layers_writer(source, bag), close, self.open_source(tile)
+        dataset = gdal.Open(tile.path, gdal.GA_ReadOnly)
+        eroded_dataset = create_output_geotiff(eroded_file, dataset, gdal.GDT_Float32, NO_DATA_VALUE)
+        eroded_band = eroded_dataset.GetRasterBand(1)
+        # The dataset is closed once the writer and its band are dropped
+        return eroded_band.WriteArray, eroded_band.FlushCache, self.open_source(tile)
+
+    def open_source(self, tile):
+        # Reader of the tile's own depths, for tiles that overlap another
+        return open_tile_reader(tile.path) if tile.path in self.overlapped else None
+
+    def __call__(self, array, xoff, yoff):
+        rows, cols = array.shape
+        for tile, window, (tile_xoff, tile_yoff, tile_cols, tile_rows) in overlapping_tiles(self.tiles, xoff, yoff, cols, rows):
+            if tile.path not in self.open_outputs:
+                self.open_outputs[tile.path] = self.open_output(tile)
+            write_tile, close_tile, read_source = self.open_outputs[tile.path]
+            eroded = array[window]
+            if read_source is not None:
+                eroded = np.where(eroded != BAG_NO_DATA_VALUE, read_source(tile_xoff, tile_yoff, tile_cols, tile_rows),
+                                  BAG_NO_DATA_VALUE).astype(np.float32, copy=False)
+            write_tile(eroded, tile_xoff, tile_yoff)
+            self.remaining[tile.path] -= tile_cols * tile_rows
+            if self.remaining[tile.path] == 0:
+                close_tile()
+                del self.open_outputs[tile.path]
+
+    def close(self):
+        for _, close_tile, _ in self.open_outputs.values():
+            close_tile()
+        self.open_outputs.clear()
+
+
+def with_mosaic_windows(engine_options):
+    # engine_options with MOSAIC_TILE_SIZE windows unless they size the windows
+    if engine_options.get("tile_size") is None and engine_options.get("max_memory") is None:
+        engine_options = dict(engine_options, tile_size=MOSAIC_TILE_SIZE)
+    return engine_options
+
+
+def erode_mosaic(input_files, output_dir, chunk_height=1000, overlap_factor=0.1, min_gap_size=6, resume=False,
+                 **engine_options):
+    # Erode the tiles as one raster and write <tile>_eroded next to each
+    # other in output_dir; returns the eroded files in input order. A
+    # cancelled run removes the tile outputs it has started.
+    if resume:
+        raise ValueError("Mosaic mode cannot resume an interrupted run; start it again without --resume")
+    mosaic = build_mosaic(input_files)
+    print(f"Mosaic of {len(mosaic.tiles)} tiles, {mosaic.width} x {mosaic.height} pixels")
+    engine_options = with_mosaic_windows(engine_options)
+    os.makedirs(output_dir, exist_ok=True)
+    writer = MosaicWriter(mosaic, output_dir)
+    try:
+        erode_raster(partial(open_mosaic_reader, mosaic), writer, mosaic.width, mosaic.height, BAG_NO_DATA_VALUE,
+                     chunk_height, overlap_factor, min_gap_size, **engine_options)
+    except ErosionCancelled:
+        writer.close()
+        for eroded_file in writer.created:
+            remove_partial_output(eroded_file)
+        raise
+    finally:
+        writer.close()
+    print('***mosaic erosion complete***')
+    return writer.outputs
+
+
+def process_mosaic(input_files, output_dir, progress, root, **engine_options):
+    # engine_options (workers, tile_size, kernel, on_event, ...) are passed through to erode_core.erode_raster
+    on_event = engine_options.get("on_event")
+    report_progress(25, progress, root, on_event)
+    eroded_files = erode_mosaic(input_files, output_dir, **engine_options)
+    report_progress(100, progress, root, on_event)
+    return eroded_files
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Coarse occupancy index: classifies every block of a raster as all-nodata,
+all-data or mixed so the erosion engine can skip homogeneous chunks. With
+global labels the seam pass fills the index in from the cores it reads
+anyway; otherwise one pass over bands of cells builds it.
+
+@author: Anthony.R.Klemm
+"""
+import numpy as np
+
+
+OCCUPANCY_NODATA = 0
+OCCUPANCY_DATA = 1
+OCCUPANCY_MIXED = 2
+
+# Cell shape used when the source has no native blocks, or has full-width strips
+DEFAULT_CELL_SHAPE = (256, 256)
+
+
+class OccupancyIndex:
+    # States of a grid of cells; row_starts and col_starts hold the first row
+    # and column of every row and column of cells
+    def __init__(self, states, row_starts, col_starts, dtype=None, data_pixels=None):
+        self.states = states
+        self.row_starts = np.asarray(row_starts)
+        self.col_starts = np.asarray(col_starts)
+        self.dtype = dtype
+        self.data_pixels = data_pixels
+
+    def cells(self, start_row, end_row, start_col, end_col):
+        # Slices of the cells a pixel window touches
+        return (slice(np.searchsorted(self.row_starts, start_row, "right") - 1, np.searchsorted(self.row_starts, end_row)),
+                slice(np.searchsorted(self.col_starts, start_col, "right") - 1, np.searchsorted(self.col_starts, end_col)))
+
+    def state(self, start_row, end_row, start_col, end_col):
+        # State of a pixel window: homogeneous only if every cell it touches is
+        cells = self.states[self.cells(start_row, end_row, start_col, end_col)]
+        if (cells == OCCUPANCY_NODATA).all():
+            return OCCUPANCY_NODATA
+        if (cells == OCCUPANCY_DATA).all():
+            return OCCUPANCY_DATA
+        return OCCUPANCY_MIXED
+
+    def record(self, start_row, start_col, gaps, dtype):
+        # Fill in the cells of a block, given its nodata mask and the raster's
+        # data type; the block must start and end on cell edges
+        rows, cols = self.cells(start_row, start_row + gaps.shape[0], start_col, start_col + gaps.shape[1])
+        row_offsets = self.row_starts[rows] - start_row
+        col_offsets = self.col_starts[cols] - start_col
+        gap_counts = np.add.reduceat(np.add.reduceat(gaps, row_offsets, axis=0), col_offsets, axis=1)
+        cell_sizes = np.outer(np.diff(np.append(row_offsets, gaps.shape[0])), np.diff(np.append(col_offsets, gaps.shape[1])))
+        states = np.full(gap_counts.shape, OCCUPANCY_MIXED, dtype=np.uint8)
+        states[gap_counts == 0] = OCCUPANCY_DATA
+        states[gap_counts == cell_sizes] = OCCUPANCY_NODATA
+        self.states[rows, cols] = states
+        self.dtype = dtype
+        self.data_pixels += gaps.size - int(gap_counts.sum())
+
+
+def window_state(occupancy, window):
+    # State of a window's buffered extent; everything is mixed without an index
+    if occupancy is None:
+        return OCCUPANCY_MIXED
+    return occupancy.state(window.buffer_start_row, window.buffer_end_row,
+                           window.buffer_start_col, window.buffer_end_col)
+
+
+def occupancy_cell_shape(block_shape, raster_width):
+    # Native blocks make natural cells; strips and missing layouts do not
+    if block_shape is None or block_shape[1] >= raster_width:
+        return DEFAULT_CELL_SHAPE
+    return tuple(block_shape)
+
+
+def core_occupancy_index(windows, cell_shape=DEFAULT_CELL_SHAPE):
+    # An empty index whose cells are about cell_shape within every window
+    # core, for erode_labels.seam_gap_areas to fill in as it reads the cores
+    cell_rows, cell_cols = cell_shape
+    row_starts = sorted({row for start_row, end_row in {(w.start_row, w.end_row) for w in windows}
+                         for row in range(start_row, end_row, cell_rows)})
+    col_starts = sorted({col for start_col, end_col in {(w.start_col, w.end_col) for w in windows}
+                         for col in range(start_col, end_col, cell_cols)})
+    states = np.full((len(row_starts), len(col_starts)), OCCUPANCY_MIXED, dtype=np.uint8)
+    return OccupancyIndex(states, row_starts, col_starts, data_pixels=0)
+
+
+def build_occupancy_index(read_window, raster_width, raster_height, no_data_value, cell_shape=DEFAULT_CELL_SHAPE,
+                          cancel=None):
+    # A pass of its own over bands of cell rows, counting the nodata pixels
+    # per cell, for runs without the seam pass. cancel, an
+    # erode_events.CancelToken, is checked before every band.
+    cell_rows, cell_cols = cell_shape
+    col_starts = np.arange(0, raster_width, cell_cols)
+    cell_widths = np.diff(np.append(col_starts, raster_width))
+    states = np.empty((-(-raster_height // cell_rows), len(col_starts)), dtype=np.uint8)
+    dtype = None
+    data_pixels = 0
+    for band_index, start_row in enumerate(range(0, raster_height, cell_rows)):
+        if cancel is not None:
+            cancel.check()
+        rows = min(cell_rows, raster_height - start_row)
+        band_data = read_window(0, start_row, raster_width, rows)
+        dtype = band_data.dtype
+        gap_counts = np.add.reduceat((band_data == no_data_value).sum(axis=0), col_starts)
+        band_states = np.full(len(col_starts), OCCUPANCY_MIXED, dtype=np.uint8)
+        band_states[gap_counts == 0] = OCCUPANCY_DATA
+        band_states[gap_counts == cell_widths * rows] = OCCUPANCY_NODATA
+        states[band_index] = band_states
+        data_pixels += band_data.size - int(gap_counts.sum())
+    return OccupancyIndex(states, np.arange(0, raster_height, cell_rows), col_starts, dtype, data_pixels)
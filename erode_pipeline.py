@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Threaded I/O pipeline: prefetching readers and a draining writer that overlap
+chunk reads and writes with the erosion.
+
+@author: Anthony.R.Klemm
+"""
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PipelineStats:
+    # Counters shared by the reader threads, the compute loop and the writer
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.chunks = 0
+        self.read_seconds = 0.0
+        self.compute_seconds = 0.0
+        self.write_seconds = 0.0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.read_queue_total = 0
+        self.read_queue_max = 0
+        self.write_queue_max = 0
+
+    def add_read(self, seconds, nbytes):
+        with self.lock:
+            self.read_seconds += seconds
+            self.bytes_read += nbytes
+
+    def add_read_queue_depth(self, depth):
+        with self.lock:
+            self.chunks += 1
+            self.read_queue_total += depth
+            self.read_queue_max = max(self.read_queue_max, depth)
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        mean_depth = self.read_queue_total / self.chunks if self.chunks else 0.0
+        return (f"Pipeline: {self.chunks} chunks in {elapsed:.2f} s; "
+                f"read {self.bytes_read / 1e6:.1f} MB ({self.read_seconds:.2f} s), "
+                f"compute {self.compute_seconds:.2f} s, "
+                f"write {self.bytes_written / 1e6:.1f} MB ({self.write_seconds:.2f} s); "
+                f"prefetch queue mean {mean_depth:.1f} / max {self.read_queue_max}, "
+                f"write queue max {self.write_queue_max}; "
+                f"{self.bytes_read / 1e6 / elapsed if elapsed else 0.0:.1f} MB/s read throughput")
+
+
+def prefetched(open_reader, items, read_item, prefetch, reader_threads, stats):
+    # Yield read_item(read_window, item) for every item, in order, while up to
+    # prefetch reads run ahead on reader_threads threads. Each thread opens
+    # its own reader, since GDAL and h5py handles are not shared across threads.
+    # read_item returns an array, or a tuple whose first element is the array.
+    local = threading.local()
+
+    def read(item):
+        if not hasattr(local, "read_window"):
+            local.read_window = open_reader()
+        start = time.perf_counter()
+        data = read_item(local.read_window, item)
+        array = data[0] if isinstance(data, tuple) else data
+        stats.add_read(time.perf_counter() - start, getattr(array, "nbytes", 0))
+        return data
+
+    with ThreadPoolExecutor(max_workers=reader_threads) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(read, item))
+            if len(pending) > prefetch:
+                stats.add_read_queue_depth(sum(future.done() for future in pending))
+                yield pending.popleft().result()
+        while pending:
+            stats.add_read_queue_depth(sum(future.done() for future in pending))
+            yield pending.popleft().result()
+
+
+class ThreadedWriter:
+    # Drains write_window(array, xoff, yoff) calls on a single thread through
+    # a bounded queue, so writes keep their order. A write error is raised
+    # on the next call or on close.
+    def __init__(self, write_window, depth, stats):
+        self.write_window = write_window
+        self.stats = stats
+        self.queue = queue.Queue(maxsize=max(1, depth))
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+            array, xoff, yoff = item
+            start = time.perf_counter()
+            try:
+                self.write_window(array, xoff, yoff)
+            except BaseException as error:
+                self.error = error
+            self.stats.write_seconds += time.perf_counter() - start
+            self.stats.bytes_written += array.nbytes
+
+    def __call__(self, array, xoff, yoff):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((array, xoff, yoff))
+        self.stats.write_queue_max = max(self.stats.write_queue_max, self.queue.qsize())
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+Memory planner: estimates the peak memory of an erosion run from the raster
+size, dtype, window layout, kernel, worker count and pipeline depth, and
+picks the largest chunks or tiles that fit a memory budget.
+
+@author: Anthony.R.Klemm
+"""
+import re
+from collections import namedtuple
+from erode_occupancy import DEFAULT_CELL_SHAPE
+from erode_windows import Window, erosion_halo, plan_tile_shape, strip_extents, tile_extents
+
+# Kernel temporaries per buffered pixel, as (fixed bytes, multiples of the
+# input itemsize); measured as the growth of peak RSS while eroding float32
+# chunks: about 5 bytes for "fused", 15 bytes for "reference"
+KERNEL_BYTES = {
+    "fused": (2, 1),
+    "reference": (7, 2),
+    }
+
+# Seam pass temporaries per core pixel (mask and 64-bit labels), plus the
+# tile itself
+SEAM_BYTES = 11
+
+# Gap label ids kept per pixel on every chunk edge: once by the seam pass and
+# once in the per-window edge areas
+EDGE_BYTES = 16
+
+# Resident size of a Python process with numpy, scipy, scikit-image and h5py
+# loaded and a BAG open (peak RSS of about 150 MB after eroding a 3000 x 2500
+# BAG in 50-row strips), charged once for the main process and once per worker
+PROCESS_BYTES = 150 * 2**20
+
+# Resident cost of each reader and writer thread of the pipeline (its stack
+# and malloc arena), about 6 MB measured with --prefetch
+THREAD_BYTES = 8 * 2**20
+
+# Strips shorter than this are not worth their halo; tiles are used instead
+MIN_CHUNK_ROWS = 64
+MIN_TILE_SIZE = 16
+
+# Step between the chunk heights and tile sizes the planner samples
+PLAN_STEP = 1.1
+
+# What the estimate needs from a window layout: the number of windows, the
+# largest buffered and core areas in pixels, and the number of distinct
+# buffered edge rows and columns inside the raster
+WindowLayout = namedtuple("WindowLayout", "windows buffered core edge_rows edge_cols")
+
+UNITS = {"": 1, "k": 2**10, "m": 2**20, "g": 2**30, "t": 2**40}
+
+
+def parse_memory(text):
+    # "4G", "512m", "2.5GB" or a plain number of bytes
+    match = re.fullmatch(r"\s*([\d.]+)\s*([kmgt]?)i?b?\s*", str(text).lower())
+    if match is None:
+        raise ValueError(f"Cannot read memory size {text!r}; use e.g. 512M or 4G")
+    return int(float(match.group(1)) * UNITS[match.group(2)])
+
+
+def format_memory(size):
+    for unit in ("TB", "GB", "MB", "kB"):
+        scale = UNITS[unit[0].lower()]
+        if size >= scale:
+            return f"{size / scale:.1f} {unit}"
+    return f"{size} B"
+
+
+def window_extents(raster_width, raster_height, chunk_height=1000, overlap_factor=0.1, tile_size=None,
+                   global_labels=True, block_shape=None, block_row_origin=0, erode_width=1):
+    # (row extents, column extents) of the windows erode_raster processes for
+    # these options, each extent (start, end, buffer_start, buffer_end): the
+    # windows are every row extent crossed with every column extent
+    halo = erosion_halo(erode_width)
+    if tile_size is None:
+        rows = strip_extents(raster_height, chunk_height, overlap_factor, halo if global_labels else 0)
+        return rows, [(0, raster_width, 0, raster_width)]
+    tile_height, tile_width = plan_tile_shape(block_shape or (1, 1), raster_width, raster_height, tile_size)
+    halo = max(halo, int(min(tile_height, tile_width) * overlap_factor))
+    return (tile_extents(raster_height, tile_height, halo, block_row_origin),
+            tile_extents(raster_width, tile_width, halo))
+
+
+def plan_windows(raster_width, raster_height, chunk_height=1000, overlap_factor=0.1, tile_size=None,
+                 global_labels=True, block_shape=None, block_row_origin=0, erode_width=1):
+    # The windows erode_raster processes for these options, row-major:
+    # full-width strips, or tiles rounded to the reader's native block shape
+    rows, cols = window_extents(raster_width, raster_height, chunk_height, overlap_factor, tile_size,
+                                global_labels, block_shape, block_row_origin, erode_width)
+    return [Window(start_row, end_row, start_col, end_col,
+                   buffer_start_row, buffer_end_row, buffer_start_col, buffer_end_col)
+            for start_row, end_row, buffer_start_row, buffer_end_row in rows
+            for start_col, end_col, buffer_start_col, buffer_end_col in cols]
+
+
+def window_layout(raster_width, raster_height, chunk_height=1000, overlap_factor=0.1, tile_size=None,
+                  global_labels=True, block_shape=None, block_row_origin=0, erode_width=1):
+    # The WindowLayout of plan_windows, from the row and column extents alone,
+    # so small tiles on a large raster are sized without listing their windows
+    rows, cols = window_extents(raster_width, raster_height, chunk_height, overlap_factor, tile_size,
+                                global_labels, block_shape, block_row_origin, erode_width)
+
+    def longest(extents, start, end):
+        return max(extent[end] - extent[start] for extent in extents)
+
+    def edges(extents, length):
+        return len({extent[2] for extent in extents if extent[2] > 0} |
+                   {extent[3] - 1 for extent in extents if extent[3] < length})
+
+    return WindowLayout(len(rows) * len(cols), longest(rows, 2, 3) * longest(cols, 2, 3),
+                        longest(rows, 0, 1) * longest(cols, 0, 1),
+                        edges(rows, raster_height), edges(cols, raster_width))
+
+
+def estimate_memory(layout, raster_width, raster_height, itemsize, workers=1, kernel="fused", prefetch=0,
+                    global_labels=True, skip_homogeneous=True, write_bytes=0, reader_threads=1):
+    # Predicted peak bytes of a run, by part, for a WindowLayout. Chunks are
+    # eroded one per worker (in the main process without workers) while up to
+    # two results per worker wait; with prefetch, prefetch + 1 chunks are read
+    # ahead by reader_threads threads and prefetch + 1 writes are queued or
+    # being written. write_bytes is what the writer allocates per core pixel
+    # beyond the eroded core (the write_window's bytes_per_pixel).
+    buffered, core = layout.buffered, layout.core
+    fixed, multiple = KERNEL_BYTES[kernel]
+    chunk = buffered * (itemsize + fixed + multiple * itemsize)
+
+    parts = dict(processes=PROCESS_BYTES * (1 + (workers if workers > 1 else 0)))
+    if prefetch > 0:
+        parts["processes"] += THREAD_BYTES * (reader_threads + 1)
+    parts["chunks"] = chunk * max(1, workers)
+    parts["in_flight"] = core * itemsize * 2 * max(1, workers)
+    if prefetch > 0:
+        parts["in_flight"] += (buffered + core) * itemsize * (prefetch + 1)
+    if write_bytes:
+        parts["writer"] = core * write_bytes
+    if skip_homogeneous and not global_labels:
+        # One band of occupancy cells, read full width (with global labels the
+        # seam pass's core reads build the index)
+        parts["occupancy"] = DEFAULT_CELL_SHAPE[0] * raster_width * (itemsize + 1)
+    if global_labels:
+        parts["seam"] = core * (itemsize + SEAM_BYTES)
+        parts["edges"] = EDGE_BYTES * (layout.edge_rows * raster_width + layout.edge_cols * raster_height)
+    # The passes run before the chunks, so only the larger phase counts
+    passes = parts.get("occupancy", 0) + parts.get("seam", 0)
+    erosion = parts["chunks"] + parts["in_flight"] + parts.get("writer", 0)
+    parts["total"] = parts["processes"] + parts.get("edges", 0) + max(passes, erosion)
+    return parts
+
+
+def plan_chunks(raster_width, raster_height, itemsize, max_memory, workers=1, kernel="fused", prefetch=0,
+                global_labels=True, skip_homogeneous=True, overlap_factor=0.1, block_shape=None, block_row_origin=0,
+                erode_width=1, write_bytes=0, reader_threads=1):
+    # The largest full-width strips that fit max_memory, or the largest tiles
+    # when no strips of at least MIN_CHUNK_ROWS do. With global labels any
+    # overlap beyond the erosion halo is wasted work, so the overlap is
+    # dropped; the legacy per-chunk mode keeps overlap_factor since its
+    # results depend on it. Returns (options for erode_raster, estimate); when
+    # nothing fits, the layout with the smallest estimate is returned and the
+    # estimate exceeds the budget (usually the per-process overhead alone is
+    # too large).
+    if global_labels:
+        overlap_factor = 0.0
+
+    def estimate(chunk_height=None, tile_size=None):
+        layout = window_layout(raster_width, raster_height, chunk_height, overlap_factor, tile_size,
+                               global_labels, block_shape, block_row_origin, erode_width)
+        return estimate_memory(layout, raster_width, raster_height, itemsize, workers, kernel, prefetch,
+                               global_labels, skip_homogeneous, write_bytes, reader_threads)
+
+    def samples(low, high):
+        # low, high and sizes PLAN_STEP apart between them
+        sizes = [low]
+        while sizes[-1] < high:
+            sizes.append(min(high, max(sizes[-1] + 1, int(sizes[-1] * PLAN_STEP))))
+        return sizes
+
+    def largest(sizes, total):
+        # The largest size that fits, or None. The estimate is not monotone in
+        # the size: short strips and small tiles hold many edges for the seam
+        # pass, large ones big chunks. So the sizes are sampled, and between
+        # the largest sample that fits and the next one, where the chunks
+        # outgrow the budget, the last fitting size is found by bisection.
+        fitting = [index for index, size in enumerate(sizes) if total(size) <= max_memory]
+        if not fitting:
+            return None
+        low = sizes[fitting[-1]]
+        if fitting[-1] + 1 < len(sizes):
+            high = sizes[fitting[-1] + 1] - 1
+            while low < high:
+                middle = (low + high + 1) // 2
+                if total(middle) <= max_memory:
+                    low = middle
+                else:
+                    high = middle - 1
+        return low
+
+    def strips(rows):
+        return estimate(chunk_height=rows)["total"]
+
+    def tiles(size):
+        return estimate(tile_size=size)["total"]
+
+    chunk_heights = samples(min(MIN_CHUNK_ROWS, raster_height), raster_height)
+    chunk_height = largest(chunk_heights, strips)
+    if chunk_height is not None:
+        return dict(chunk_height=chunk_height, tile_size=None, overlap_factor=overlap_factor), estimate(chunk_height=chunk_height)
+    tile_sizes = samples(MIN_TILE_SIZE, max(raster_width, raster_height, MIN_TILE_SIZE))
+    tile_size = largest(tile_sizes, tiles)
+    if tile_size is not None:
+        return dict(chunk_height=None, tile_size=tile_size, overlap_factor=overlap_factor), estimate(tile_size=tile_size)
+
+    chunk_height = min(chunk_heights, key=strips)
+    tile_size = min(tile_sizes, key=tiles)
+    if tiles(tile_size) < strips(chunk_height):
+        return dict(chunk_height=None, tile_size=tile_size, overlap_factor=overlap_factor), estimate(tile_size=tile_size)
+    return dict(chunk_height=chunk_height, tile_size=None, overlap_factor=overlap_factor), estimate(chunk_height=chunk_height)
+
+
+def describe_plan(options, estimate, max_memory=None):
+    layout = (f"strips of {options['chunk_height']} rows" if options.get("tile_size") is None
+              else f"tiles of about {options['tile_size']} pixels")
+    parts = ", ".join(f"{name} {format_memory(size)}" for name, size in estimate.items() if name != "total")
+    budget = f" (budget {format_memory(max_memory)})" if max_memory is not None else ""
+    warning = " -- over budget, nothing smaller fits" if max_memory is not None and estimate["total"] > max_memory else ""
+    return (f"Memory plan: {layout}, overlap factor {options['overlap_factor']}; "
+            f"predicted peak {format_memory(estimate['total'])}{budget}{warning} [{parts}]")
+
+
+def dry_run(open_reader, raster_width, raster_height, chunk_height=1000, overlap_factor=0.1, workers=1,
+            global_labels=True, tile_size=None, skip_homogeneous=True, kernel="fused", prefetch=0,
+            max_memory=None, erode_width=1, write_bytes=0, reader_threads=1, **_):
+    # Print the plan erode_raster would follow, and its predicted peak memory,
+    # without eroding anything. write_bytes is the writer's cost per core
+    # pixel, as for estimate_memory.
+    read_window = open_reader()
+    itemsize = read_window(0, 0, 1, 1).dtype.itemsize
+    block_shape = getattr(read_window, "block_shape", None)
+    block_row_origin = getattr(read_window, "block_row_origin", 0)
+    if max_memory is not None:
+        options, estimate = plan_chunks(raster_width, raster_height, itemsize, max_memory, workers, kernel, prefetch,
+                                        global_labels, skip_homogeneous, overlap_factor, block_shape, block_row_origin,
+                                        erode_width, write_bytes, reader_threads)
+    else:
+        options = dict(chunk_height=chunk_height, tile_size=tile_size, overlap_factor=overlap_factor)
+        estimate = estimate_memory(window_layout(raster_width, raster_height, chunk_height, overlap_factor, tile_size,
+                                                 global_labels, block_shape, block_row_origin, erode_width),
+                                   raster_width, raster_height, itemsize, workers, kernel, prefetch,
+                                   global_labels, skip_homogeneous, write_bytes, reader_threads)
+    layout = window_layout(raster_width, raster_height, options["chunk_height"], options["overlap_factor"],
+                           options["tile_size"], global_labels, block_shape, block_row_origin, erode_width)
+    print(f"Raster {raster_width} x {raster_height}, {itemsize}-byte pixels, {layout.windows} chunks, {max(1, workers)} worker(s)")
+    print(describe_plan(options, estimate, max_memory))
+    return options, estimate
@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+"""
+Shard mode: split the erosion of one raster across several processes or
+nodes that share a directory, with no services beyond the file system.
+
+  plan      the coordinator sizes the gaps across the whole raster and
+            writes a manifest of buffered windows, with everything each
+            window needs for an exact result, to the shard directory
+  work      any number of workers, on any node, claim windows with atomic
+            lock files, erode them and deposit their cores as partials
+  assemble  stitches the partials into the eroded BAG or GeoTIFF
+
+A worker that dies leaves its lock behind; once the lock is older than
+stale_after seconds another worker takes the window over. Partials are
+replaced atomically and a window always erodes to the same core, so a
+window eroded twice is only wasted work.
+
+@author: Anthony.R.Klemm
+"""
+import contextlib
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import threading
+import time
+import numpy as np
+from osgeo import gdal
+import h5py
+from erode_bag_functions import masked_layers_writer, start_bag_copy
+from erode_checkpoint import source_fingerprint
+from erode_core import erode_read_chunks, read_chunk
+from erode_geotiff_functions import NO_DATA_VALUE
+from erode_io import create_output_geotiff, open_input
+from erode_labels import seam_gap_areas
+from erode_occupancy import build_occupancy_index, core_occupancy_index, occupancy_cell_shape, window_state
+from erode_planner import describe_plan, plan_chunks, plan_windows
+from erode_windows import Window
+
+MANIFEST_NAME = "manifest.json"
+
+# Seconds after which the lock of a window without a partial is taken over
+STALE_AFTER = 600.0
+
+# Seconds a worker waits before looking again at windows others hold
+POLL_INTERVAL = 5.0
+
+# A worker refreshes the lock of the window it erodes this many times per
+# stale_after, so only the locks of dead workers go stale
+HEARTBEATS_PER_STALE = 4
+
+# The edges of erode_labels.seam_gap_areas by name, for the window files
+EDGES = {
+    "top": (0, slice(None)),
+    "bottom": (-1, slice(None)),
+    "left": (slice(None), 0),
+    "right": (slice(None), -1),
+    }
+
+
+def shard_path(shard_dir, index, suffix):
+    # Per-window files: .window (the plan) and .edges.npy (its edge gap
+    # areas), .lock (the claim), .npy (the partial)
+    return os.path.join(shard_dir, "windows", f"{index:06d}{suffix}")
+
+
+def write_atomically(path, write):
+    # write(file) into a temporary file that then replaces path, so readers
+    # on any node see the whole file or none of it
+    temporary_path = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(temporary_path, "wb") as temporary_file:
+        write(temporary_file)
+    os.replace(temporary_path, path)
+
+
+def check_shard_dir(shard_dir):
+    # Shard directories are only ever emptied of what plan_shards wrote, so
+    # refuse a directory holding anything else and no manifest
+    if os.path.isdir(shard_dir) and os.listdir(shard_dir) and not os.path.exists(os.path.join(shard_dir, MANIFEST_NAME)):
+        raise ValueError(f"{shard_dir} is not empty and holds no {MANIFEST_NAME}; give an empty or new shard directory")
+
+
+def remove_shards(shard_dir):
+    # Remove the manifest (first, so workers stop taking the plan) and the
+    # per-window files, leaving anything else in shard_dir alone
+    manifest_path = os.path.join(shard_dir, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    shutil.rmtree(os.path.join(shard_dir, "windows"), ignore_errors=True)
+
+
+def load_manifest(shard_dir):
+    with open(os.path.join(shard_dir, MANIFEST_NAME)) as manifest_file:
+        return json.load(manifest_file)
+
+
+def save_window(shard_dir, index, window, state, edge_areas):
+    # The plan of a window as JSON, and its edge gap areas as one plain
+    # array: the shard directory is shared, so nothing in it is unpickled
+    edges = None
+    if edge_areas is not None:
+        edges = [[next(name for name, edge in EDGES.items() if edge == edge_index), len(areas)]
+                 for edge_index, areas in edge_areas]
+        areas = np.concatenate([areas for _, areas in edge_areas]) if edge_areas else np.zeros(0, dtype=np.int64)
+        write_atomically(shard_path(shard_dir, index, ".edges.npy"), lambda edges_file: np.save(edges_file, areas))
+    item = dict(window=[int(value) for value in window], state=int(state), edges=edges)
+    write_atomically(shard_path(shard_dir, index, ".window"), lambda window_file: window_file.write(json.dumps(item).encode()))
+
+
+def load_window(shard_dir, index):
+    # (window, occupancy state, edge_areas)
+    with open(shard_path(shard_dir, index, ".window")) as window_file:
+        item = json.load(window_file)
+    edge_areas = None
+    if item["edges"] is not None:
+        areas = np.load(shard_path(shard_dir, index, ".edges.npy"), allow_pickle=False)
+        edge_areas = []
+        start = 0
+        for name, length in item["edges"]:
+            edge_areas.append((EDGES[name], areas[start : start + length]))
+            start += length
+    return Window(*item["window"]), item["state"], edge_areas
+
+
+def plan_shards(input_file, shard_dir, chunk_height=1000, overlap_factor=0.1, min_gap_size=6, global_labels=True,
+                tile_size=None, skip_homogeneous=True, kernel="fused", max_memory=None, erode_width=1):
+    # Coordinator: plan the windows as erode_core.erode_raster would, run the
+    # seam pass (which also builds the occupancy index) over the whole raster,
+    # or the occupancy pass without global labels, and write one file per
+    # window with its occupancy state and whole-raster edge gap areas. The
+    # manifest is written last, so workers never see a partial plan.
+    check_shard_dir(shard_dir)
+    open_reader, raster_width, raster_height, no_data_value = open_input(input_file)
+    read_window = open_reader()
+    block_shape = getattr(read_window, "block_shape", None)
+    block_row_origin = getattr(read_window, "block_row_origin", 0)
+    dtype = read_window(0, 0, 1, 1).dtype
+    if max_memory is not None:
+        # Every worker process erodes one chunk at a time
+        options, estimate = plan_chunks(raster_width, raster_height, dtype.itemsize, max_memory, 1, kernel, 0,
+                                        global_labels, skip_homogeneous, overlap_factor, block_shape, block_row_origin,
+                                        erode_width)
+        chunk_height, tile_size, overlap_factor = options["chunk_height"], options["tile_size"], options["overlap_factor"]
+        print(describe_plan(options, estimate, max_memory))
+    windows = plan_windows(raster_width, raster_height, chunk_height, overlap_factor, tile_size,
+                           global_labels, block_shape, block_row_origin, erode_width)
+    print(f"Number of chunks: {len(windows)}")
+
+    occupancy = None
+    if skip_homogeneous and global_labels:
+        occupancy = core_occupancy_index(windows, occupancy_cell_shape(block_shape, raster_width))
+    elif skip_homogeneous:
+        print("Building occupancy index...")
+        occupancy = build_occupancy_index(read_window, raster_width, raster_height, no_data_value,
+                                          occupancy_cell_shape(block_shape, raster_width))
+    window_edge_areas = [None] * len(windows)
+    if global_labels:
+        print("Labelling gaps across chunk seams...")
+        window_edge_areas = seam_gap_areas(read_window, windows, raster_width, raster_height, no_data_value, occupancy)
+
+    # A fresh plan: partials and locks of an earlier plan must not count
+    check_shard_dir(shard_dir)
+    remove_shards(shard_dir)
+    os.makedirs(os.path.join(shard_dir, "windows"))
+    for index, (window, edge_areas) in enumerate(zip(windows, window_edge_areas)):
+        save_window(shard_dir, index, window, window_state(occupancy, window), edge_areas)
+    manifest = dict(input=os.path.abspath(input_file), source=source_fingerprint(input_file),
+                    raster_width=raster_width, raster_height=raster_height, no_data_value=float(no_data_value),
+                    dtype=dtype.str, windows=len(windows), min_gap_size=min_gap_size, kernel=kernel,
+                    erode_width=erode_width, global_labels=global_labels, created=time.time())
+    write_atomically(os.path.join(shard_dir, MANIFEST_NAME),
+                     lambda manifest_file: manifest_file.write(json.dumps(manifest, indent=2).encode()))
+    print(f"***planned {len(windows)} windows in {shard_dir}***")
+    return manifest
+
+
+def claim_window(shard_dir, index, stale_after=STALE_AFTER):
+    # Claim a window by creating its lock file exclusively. A stale lock (its
+    # worker died, or it would have kept the lock fresh) is first moved
+    # aside, which only one worker can do, and then created again
+    # exclusively. Returns True if this worker should erode the window.
+    lock_path = shard_path(shard_dir, index, ".lock")
+    owner = json.dumps(dict(host=socket.gethostname(), pid=os.getpid(), time=time.time()))
+    try:
+        lock = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        try:
+            age = time.time() - os.stat(lock_path).st_mtime
+        except FileNotFoundError:
+            return False
+        if age < stale_after:
+            return False
+        stale_path = f"{lock_path}.{socket.gethostname()}.{os.getpid()}.stale"
+        try:
+            os.rename(lock_path, stale_path)
+        except FileNotFoundError:
+            return False
+        if time.time() - os.stat(stale_path).st_mtime < stale_after:
+            # Another worker took the window over in the meantime: put its
+            # lock back
+            with contextlib.suppress(FileExistsError):
+                os.link(stale_path, lock_path)
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+        try:
+            lock = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        print(f"Taking over window {index + 1}: its lock is {age:.0f} s old")
+    with os.fdopen(lock, "w") as lock_file:
+        lock_file.write(owner)
+    return True
+
+
+@contextlib.contextmanager
+def lock_heartbeat(lock_path, interval):
+    # Refresh the lock's modification time from a background thread while
+    # the window is eroded, however long that takes
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(interval):
+            try:
+                os.utime(lock_path)
+            except FileNotFoundError:
+                return
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def run_worker(shard_dir, stale_after=STALE_AFTER, poll_interval=POLL_INTERVAL, cache=None):
+    # Claim, erode and deposit windows until every window has a partial.
+    # cache, an erode_cache.BlockCache, is shared like in erode_raster.
+    # Returns the number of windows this worker eroded.
+    manifest = load_manifest(shard_dir)
+    read_window = open_input(manifest["input"])[0]()
+    no_data_value = manifest["no_data_value"]
+    dtype = np.dtype(manifest["dtype"])
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    eroded = 0
+    while True:
+        pending = [index for index in range(manifest["windows"]) if not os.path.exists(shard_path(shard_dir, index, ".npy"))]
+        if not pending:
+            break
+        claimed = 0
+        for index in pending:
+            if os.path.exists(shard_path(shard_dir, index, ".npy")) or not claim_window(shard_dir, index, stale_after):
+                continue
+            with lock_heartbeat(shard_path(shard_dir, index, ".lock"), stale_after / HEARTBEATS_PER_STALE):
+                window, state, edge_areas = load_window(shard_dir, index)
+                reads = [((window, state, edge_areas), read_chunk(read_window, window, state, no_data_value, dtype))]
+                for _, core, _ in erode_read_chunks(reads, no_data_value, manifest["min_gap_size"], manifest["kernel"],
+                                                    erode_width=manifest["erode_width"], cache=cache):
+                    write_atomically(shard_path(shard_dir, index, ".npy"), lambda part_file: np.save(part_file, core))
+            print(f"Worker {worker} eroded window {index + 1} of {manifest['windows']}")
+            claimed += 1
+        eroded += claimed
+        if not claimed:
+            # The rest is held by other workers: wait for them to finish, or
+            # for their locks to go stale
+            time.sleep(poll_interval)
+    if cache is not None:
+        cache.evict()
+    print(f"***worker {worker} finished: {eroded} windows eroded***")
+    return eroded
+
+
+def run_workers(shard_dir, processes=1, **worker_options):
+    # Run worker processes on this machine and wait for them
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=run_worker, args=(shard_dir,), kwargs=worker_options) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    failed = sum(worker.exitcode != 0 for worker in workers)
+    if failed:
+        raise RuntimeError(f"{failed} of {processes} workers failed")
+
+
+def write_partials(shard_dir, manifest, write_window):
+    for index in range(manifest["windows"]):
+        window = load_window(shard_dir, index)[0]
+        write_window(np.load(shard_path(shard_dir, index, ".npy"), allow_pickle=False), window.start_col, window.start_row)
+
+
+def assemble_shards(shard_dir, output_dir, keep_shards=False):
+    # Stitch the partials into <input>_eroded in output_dir, written as the
+    # h5py BAG engine and the GeoTIFF workflow write it, then remove the
+    # manifest and window files unless keep_shards (and shard_dir itself if
+    # nothing else is left in it)
+    manifest = load_manifest(shard_dir)
+    missing = [index for index in range(manifest["windows"]) if not os.path.exists(shard_path(shard_dir, index, ".npy"))]
+    if missing:
+        raise RuntimeError(f"{len(missing)} of {manifest['windows']} windows are not eroded yet "
+                           f"(first: window {missing[0] + 1}); run more workers before assembling")
+    input_file = manifest["input"]
+    if source_fingerprint(input_file) != manifest["source"]:
+        raise RuntimeError(f"{input_file} has changed since the shards were planned; plan them again")
+
+    os.makedirs(output_dir, exist_ok=True)
+    stem, extension = os.path.splitext(os.path.basename(input_file))
+    eroded_file = os.path.join(output_dir, stem + "_eroded" + extension)
+    print(f"Assembling {manifest['windows']} windows into {eroded_file}...")
+    if input_file.lower().endswith(".bag"):
+        start_bag_copy(input_file, eroded_file)
+        with h5py.File(input_file, "r") as source, h5py.File(eroded_file, "r+") as bag:
+            write_partials(shard_dir, manifest, masked_layers_writer(source, bag))
+    else:
+        dataset = gdal.Open(input_file, gdal.GA_ReadOnly)
+        eroded_dataset = create_output_geotiff(eroded_file, dataset, gdal.GDT_Float32, NO_DATA_VALUE)
+        eroded_band = eroded_dataset.GetRasterBand(1)
+        write_partials(shard_dir, manifest, eroded_band.WriteArray)
+        eroded_band.FlushCache()
+        dataset = None
+        eroded_band = None
+        eroded_dataset = None
+    if not keep_shards:
+        remove_shards(shard_dir)
+        if not os.listdir(shard_dir):
+            os.rmdir(shard_dir)
+    print('***assembly complete***')
+    return eroded_file
+
+
+if __name__ == "__main__":
+    import argparse
+    from erode_cache import DEFAULT_CACHE_BYTES, BlockCache
+    from erode_core import KERNELS, parse_erode_width
+    from erode_planner import parse_memory
+
+    parser = argparse.ArgumentParser(description='Erode one BAG or GeoTIFF across several processes or nodes sharing a directory.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    plan_parser = commands.add_parser('plan', help='Write the work manifest of a raster to a shard directory.')
+    plan_parser.add_argument('input_file', help='The BAG or GeoTIFF to erode, on a path every worker can read.')
+    plan_parser.add_argument('shard_dir', help='The shared directory for the manifest, locks and partials: new, empty or holding an earlier plan, which is replaced.')
+    plan_parser.add_argument('--tile-size', type=int, default=None,
+                             help='Windows of about this many pixels a side instead of full-width row strips.')
+    plan_parser.add_argument('--max-memory', type=parse_memory, default=None,
+                             help='Memory budget of each worker, such as 4G: picks the window size predicted to fit.')
+    plan_parser.add_argument('--erode-width', type=parse_erode_width, default=1,
+                             help='Number of pixels trimmed off the edges of large gaps (default 1).')
+    plan_parser.add_argument('--kernel', choices=sorted(KERNELS), default='fused', help='Per-chunk erosion kernel.')
+    plan_parser.add_argument('--per-chunk-labels', action='store_true',
+                             help='Size gaps within each window only (legacy behaviour).')
+
+    work_parser = commands.add_parser('work', help='Erode windows of a planned shard directory until none are left.')
+    work_parser.add_argument('shard_dir', help='The shard directory written by plan.')
+    work_parser.add_argument('--processes', type=int, default=1, help='Number of worker processes to run on this machine.')
+    work_parser.add_argument('--stale-after', type=float, default=STALE_AFTER,
+                             help='Seconds after which a window locked by a silent worker is taken over.')
+    work_parser.add_argument('--cache', default=None, metavar='DIR', help='Block cache directory, see erode_cache.py.')
+    work_parser.add_argument('--cache-size', type=parse_memory, default=DEFAULT_CACHE_BYTES,
+                             help='Size bound of the --cache directory (default 2G).')
+
+    assemble_parser = commands.add_parser('assemble', help='Stitch the partials into the eroded output.')
+    assemble_parser.add_argument('shard_dir', help='The shard directory written by plan and the workers.')
+    assemble_parser.add_argument('output_dir', help='The directory to write the eroded BAG or GeoTIFF to.')
+    assemble_parser.add_argument('--keep-shards', action='store_true', help='Keep the shard directory after assembling.')
+
+    args = parser.parse_args()
+
+    if args.command == 'plan':
+        plan_shards(args.input_file, args.shard_dir, global_labels=not args.per_chunk_labels, tile_size=args.tile_size,
+                    kernel=args.kernel, max_memory=args.max_memory, erode_width=args.erode_width)
+    elif args.command == 'work':
+        cache = BlockCache(args.cache, args.cache_size) if args.cache else None
+        run_workers(args.shard_dir, args.processes, stale_after=args.stale_after, cache=cache)
+    else:
+        assemble_shards(args.shard_dir, args.output_dir, args.keep_shards)
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic survey rasters for benchmarks and equivalence checks: depths in a
+meandering swath with a controlled coverage fraction and gap-size distribution.
+
+@author: Anthony.R.Klemm
+"""
+import numpy as np
+import h5py
+
+NO_DATA_VALUE = 1000000.0
+
+# Rows generated at a time, so rasters can be written far larger than memory
+BAND_ROWS = 1024
+
+
+def synthetic_band(raster_width, start_row, rows, coverage=0.7, gap_density=50.0, gap_size=3.0, seed=0):
+    # Depths inside a meandering survey swath covering about coverage of each
+    # row, with gap_density holes per megapixel whose sides are geometric
+    # with mean gap_size pixels. Each band has its own seed, so any band can be
+    # regenerated alone.
+    rng = np.random.default_rng((seed, start_row))
+    row_index = np.arange(start_row, start_row + rows)[:, None]
+    col_index = np.arange(raster_width)[None, :]
+    half_width = coverage * raster_width / 2
+    center = raster_width / 2 + (raster_width / 2 - half_width) * np.sin(row_index / 500.0)
+    band = (-20.0 - 0.001 * col_index + rng.normal(0, 0.5, (rows, raster_width))).astype(np.float32)
+    band[np.abs(col_index - center) > half_width] = NO_DATA_VALUE
+
+    num_holes = rng.poisson(gap_density * rows * raster_width / 1e6)
+    hole_rows = rng.integers(0, rows, num_holes)
+    hole_cols = rng.integers(0, raster_width, num_holes)
+    heights = rng.geometric(1 / gap_size, num_holes)
+    widths = rng.geometric(1 / gap_size, num_holes)
+    for r, c, h, w in zip(hole_rows, hole_cols, heights, widths):
+        band[r:r + h, c:c + w] = NO_DATA_VALUE
+    return band
+
+
+def synthetic_bands(raster_width, raster_height, **params):
+    # Yield (start_row, band) pairs covering the raster top to bottom
+    for start_row in range(0, raster_height, BAND_ROWS):
+        rows = min(BAND_ROWS, raster_height - start_row)
+        yield start_row, synthetic_band(raster_width, start_row, rows, **params)
+
+
+def synthetic_raster(raster_width, raster_height, **params):
+    # The whole raster in memory
+    raster = np.empty((raster_height, raster_width), dtype=np.float32)
+    for start_row, band in synthetic_bands(raster_width, raster_height, **params):
+        raster[start_row:start_row + band.shape[0]] = band
+    return raster
+
+
+def write_synthetic_bag(path, raster_width, raster_height, **params):
+    # Minimal BAG layout: south-up elevation and uncertainty grids plus metadata
+    with h5py.File(path, "w") as bag:
+        root = bag.create_group("BAG_root")
+        options = dict(shape=(raster_height, raster_width), dtype=np.float32, chunks=(100, 100),
+                       compression="gzip", fillvalue=NO_DATA_VALUE)
+        elevation = root.create_dataset("elevation", **options)
+        uncertainty = root.create_dataset("uncertainty", **options)
+        root.create_dataset("metadata", data=np.frombuffer(b"<gmi:MI_Metadata/>", dtype="S1"))
+        for start_row, band in synthetic_bands(raster_width, raster_height, **params):
+            rows = band.shape[0]
+            flipped = slice(raster_height - start_row - rows, raster_height - start_row)
+            elevation[flipped] = band[::-1]
+            uncertainty[flipped] = np.where(band != NO_DATA_VALUE, np.float32(0.5), np.float32(NO_DATA_VALUE))[::-1]
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+Equivalence oracle: erodes a raster as one whole in-memory array with the
+reference kernel, then runs engine configurations (chunk height, overlap,
+workers, tiles, kernel, ...) and compares their output pixel for pixel,
+reporting every written window that differs. It also erodes synthetic BAGs
+with memory budgets and checks that the peak RSS of each run stays within
+its budget.
+
+The whole raster is held in memory, so use it on synthetic rasters or on
+user-supplied rasters that fit.
+
+@author: Anthony.R.Klemm
+"""
+import contextlib
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+from erode_arrays import erode_array, open_array_reader
+from erode_core import KERNELS, erode_raster
+from erode_io import open_input
+from erode_events import peak_memory_mb
+from erode_planner import format_memory, parse_memory
+from erode_synthetic import NO_DATA_VALUE, synthetic_raster, write_synthetic_bag
+
+
+def reference_erosion(data, no_data_value, min_gap_size=6, erode_width=1):
+    # The original step-by-step algorithm applied to the whole raster as a single chunk
+    return erode_array(data, no_data_value, min_gap_size, kernel="reference", erode_width=erode_width)
+
+
+def run_configuration(open_reader, raster_width, raster_height, no_data_value, dtype, min_gap_size=6, **config):
+    # Erode with one engine configuration into an in-memory output, keeping
+    # every window written and how often each pixel was written
+    output = np.full((raster_height, raster_width), no_data_value, dtype=dtype)
+    written = np.zeros((raster_height, raster_width), dtype=np.uint16)
+    writes = []
+
+    def write_window(array, xoff, yoff):
+        rows, cols = array.shape
+        output[yoff:yoff + rows, xoff:xoff + cols] = array
+        written[yoff:yoff + rows, xoff:xoff + cols] += 1
+        writes.append((yoff, yoff + rows, xoff, xoff + cols))
+
+    erode_raster(open_reader, write_window, raster_width, raster_height, no_data_value,
+                 min_gap_size=min_gap_size, **config)
+    return output, writes, written
+
+
+def compare_to_reference(reference, output, writes, written):
+    # Every written window whose pixels differ, with the count and the first
+    # differing pixel, plus pixels never written or written more than once
+    differing_windows = []
+    for index, (start_row, end_row, start_col, end_col) in enumerate(writes):
+        differs = reference[start_row:end_row, start_col:end_col] != output[start_row:end_row, start_col:end_col]
+        count = int(np.count_nonzero(differs))
+        if count:
+            rows, cols = np.nonzero(differs)
+            differing_windows.append(dict(
+                window=index, rows=[start_row, end_row], cols=[start_col, end_col], pixels=count,
+                first_pixel=[start_row + int(rows[0]), start_col + int(cols[0])],
+                ))
+    unwritten = int(np.count_nonzero(written == 0))
+    overwritten = int(np.count_nonzero(written > 1))
+    return dict(
+        equal=not differing_windows and unwritten == 0 and np.array_equal(reference, output),
+        differing_windows=differing_windows,
+        differing_pixels=sum(window["pixels"] for window in differing_windows),
+        unwritten_pixels=unwritten,
+        overwritten_pixels=overwritten,
+        )
+
+
+def verify(open_reader, raster_width, raster_height, no_data_value, configurations, min_gap_size=6, verbose=False):
+    # Compare every configuration against the whole-array reference
+    read_window = open_reader()
+    data = np.asarray(read_window(0, 0, raster_width, raster_height))
+    references = {}
+    reports = []
+    for config in configurations:
+        erode_width = config.get("erode_width", 1)
+        if erode_width not in references:
+            references[erode_width] = reference_erosion(data, no_data_value, min_gap_size, erode_width)
+        reference = references[erode_width]
+        # The engine narrates every chunk; keep that out of the report
+        with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+            output, writes, written = run_configuration(open_reader, raster_width, raster_height, no_data_value,
+                                                        data.dtype, min_gap_size, **config)
+        report = compare_to_reference(reference, output, writes, written)
+        report.update(config=config, windows=len(writes))
+        reports.append(report)
+    return reports
+
+
+def configuration_matrix(chunk_heights=(50, 1000), overlap_factors=(0.1,), workers=(1, 2), tile_sizes=(None, 64),
+                         kernels=("fused",), prefetch=(0,), skip_homogeneous=(True,), global_labels=(True,),
+                         erode_widths=(1,)):
+    # Every combination; chunk heights and overlap factors only shape strips,
+    # so tiled runs take each tile size once per overlap factor
+    configurations = []
+    for values in itertools.product(chunk_heights, overlap_factors, workers, tile_sizes, kernels, prefetch,
+                                    skip_homogeneous, global_labels, erode_widths):
+        config = dict(zip(("chunk_height", "overlap_factor", "workers", "tile_size", "kernel", "prefetch",
+                           "skip_homogeneous", "global_labels", "erode_width"), values))
+        if config["tile_size"] is not None:
+            config["chunk_height"] = None
+        if config not in configurations:
+            configurations.append(config)
+    return configurations
+
+
+# (width, height, budget, engine options) of synthetic BAGs eroded with
+# max_memory; the peak RSS of each run must stay within its budget
+PLANNER_CHECKS = (
+    (6000, 5000, "200M", {}),
+    (6000, 5000, "300M", {}),
+    (6000, 5000, "300M", dict(kernel="reference")),
+    (6000, 5000, "300M", dict(prefetch=2)),
+    )
+
+
+def peak_rss():
+    # Peak RSS of this process in bytes, or None. Linux keeps ru_maxrss across
+    # exec, so a freshly spawned process would report its parent's peak;
+    # VmHWM in /proc is the process's own.
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = peak_memory_mb()
+    return None if peak is None else int(peak * 2**20)
+
+
+def measure_plan(input_bag, eroded_bag, max_memory, options):
+    # Runs in a fresh process: erode a BAG within max_memory and return the
+    # memory plan it printed and the process's peak RSS in bytes (or None)
+    from erode_bag_functions import erode_bag_h5py
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        erode_bag_h5py(input_bag, eroded_bag, max_memory=max_memory, **options)
+    plan = next(line for line in output.getvalue().splitlines() if line.startswith("Memory plan"))
+    return plan, peak_rss()
+
+
+def check_planner(checks=PLANNER_CHECKS):
+    # Erode every check's synthetic BAG, each run in a fresh process so the
+    # peak RSS is its own, and compare it with the budget; returns the
+    # number of runs over budget
+    failures = 0
+    with tempfile.TemporaryDirectory() as directory:
+        for raster_width, raster_height, budget, options in checks:
+            input_bag = os.path.join(directory, f"planner_{raster_width}x{raster_height}.bag")
+            if not os.path.exists(input_bag):
+                write_synthetic_bag(input_bag, raster_width, raster_height)
+            max_memory = parse_memory(budget)
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                plan, peak = pool.submit(measure_plan, input_bag, os.path.join(directory, "eroded.bag"), max_memory,
+                                         options).result()
+            name = f"planner {raster_width} x {raster_height}" + "".join(f", {key}={value}" for key, value in options.items())
+            if peak is None:
+                print(f"{'SKIPPED':<10}{name}: peak RSS is not available here; {plan}")
+                continue
+            fits = peak <= max_memory
+            failures += not fits
+            print(f"{'OK' if fits else 'OVER':<10}{name}: peak RSS {format_memory(peak)}; {plan}")
+    return failures
+
+
+def print_report(name, reports):
+    for report in reports:
+        config = ", ".join(f"{key}={value}" for key, value in report["config"].items() if value is not None)
+        if report["equal"]:
+            print(f"OK        {name}: {config} ({report['windows']} windows)")
+            continue
+        print(f"MISMATCH  {name}: {config}: {report['differing_pixels']} pixels differ in "
+              f"{len(report['differing_windows'])} of {report['windows']} windows, "
+              f"{report['unwritten_pixels']} unwritten, {report['overwritten_pixels']} written twice")
+        for window in report["differing_windows"]:
+            print(f"          rows {window['rows'][0]}-{window['rows'][1]}, cols {window['cols'][0]}-{window['cols'][1]}: "
+                  f"{window['pixels']} pixels, first at row {window['first_pixel'][0]}, col {window['first_pixel'][1]}")
+
+
+def parse_list(text, convert):
+    return tuple(None if item.lower() == "none" else convert(item) for item in text.split(","))
+
+
+def parse_switch(text):
+    return tuple(item.lower() in ("on", "true", "1", "yes") for item in text.split(","))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Check engine configurations against whole-raster erosion, pixel for pixel.')
+    parser.add_argument('inputs', nargs='*', help='BAG or GeoTIFF files to check (loaded whole into memory).')
+    parser.add_argument('--synthetic', default='1200x900', help='Comma separated WIDTHxHEIGHT synthetic rasters to check ("" for none).')
+    parser.add_argument('--seeds', type=int, default=2, help='Number of seeds per synthetic size.')
+    parser.add_argument('--coverage', type=float, default=0.7, help='Synthetic swath coverage fraction.')
+    parser.add_argument('--gap-density', type=float, default=2000.0, help='Synthetic holes per megapixel.')
+    parser.add_argument('--gap-size', type=float, default=3.0, help='Mean side of a synthetic hole in pixels.')
+    parser.add_argument('--min-gap-size', type=int, default=6, help='Gaps smaller than this are kept.')
+    parser.add_argument('--chunk-heights', default='50,1000', help='Comma separated strip heights.')
+    parser.add_argument('--overlap-factors', default='0.1', help='Comma separated overlap factors.')
+    parser.add_argument('--workers', default='1,2', help='Comma separated worker counts.')
+    parser.add_argument('--tile-sizes', default='none,64', help='Comma separated tile sizes ("none" for strips).')
+    parser.add_argument('--kernels', default='fused', help='Comma separated kernels: ' + ', '.join(sorted(KERNELS)) + '.')
+    parser.add_argument('--prefetch', default='0', help='Comma separated prefetch depths.')
+    parser.add_argument('--skip-homogeneous', default='on', help='Comma separated on/off values.')
+    parser.add_argument('--global-labels', default='on', help='Comma separated on/off values ("off" is the legacy per-chunk labelling, which is expected to differ).')
+    parser.add_argument('--erode-widths', default='1', help='Comma separated erosion widths.')
+    parser.add_argument('--report', default=None, help='Write the full JSON report here.')
+    parser.add_argument('--no-planner', dest='planner', action='store_false', help='Skip the memory planner checks.')
+    parser.add_argument('--verbose', action='store_true', help='Show the engine output of every run.')
+
+    args = parser.parse_args()
+
+    configurations = configuration_matrix(
+        parse_list(args.chunk_heights, int), parse_list(args.overlap_factors, float), parse_list(args.workers, int),
+        parse_list(args.tile_sizes, int), tuple(args.kernels.split(",")), parse_list(args.prefetch, int),
+        parse_switch(args.skip_homogeneous), parse_switch(args.global_labels), parse_list(args.erode_widths, int))
+
+    checks = []
+    for size in filter(None, args.synthetic.split(",")):
+        width, height = (int(value) for value in size.lower().split("x"))
+        for seed in range(args.seeds):
+            data = synthetic_raster(width, height, coverage=args.coverage, gap_density=args.gap_density,
+                                    gap_size=args.gap_size, seed=seed)
+            checks.append((f"synthetic {size} seed {seed}", partial(open_array_reader, data), width, height, NO_DATA_VALUE))
+    for input_file in args.inputs:
+        checks.append((os.path.basename(input_file), *open_input(input_file)))
+
+    full_report = {}
+    for name, open_reader, raster_width, raster_height, no_data_value in checks:
+        reports = verify(open_reader, raster_width, raster_height, no_data_value, configurations,
+                         args.min_gap_size, args.verbose)
+        print_report(name, reports)
+        full_report[name] = reports
+
+    mismatches = sum(not report["equal"] for reports in full_report.values() for report in reports)
+    print(f"{mismatches} of {sum(len(reports) for reports in full_report.values())} runs differ from the whole-raster reference")
+    if args.report:
+        with open(args.report, "w") as report_file:
+            json.dump(full_report, report_file, indent=2)
+    over_budget = check_planner() if args.planner else 0
+    sys.exit(1 if mismatches or over_budget else 0)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Chunk and tile schedulers for the erosion engine.
+
+@author: Anthony.R.Klemm
+"""
+from collections import namedtuple
+
+
+# Core area written to the output, and the buffered area read around it
+Window = namedtuple("Window", [
+    "start_row", "end_row", "start_col", "end_col",
+    "buffer_start_row", "buffer_end_row", "buffer_start_col", "buffer_end_col",
+    ])
+
+
+def check_erode_width(erode_width):
+    # At least one pixel is trimmed; 0 or less would leave nothing to erode
+    # (or grow the gaps' data instead)
+    if erode_width < 1:
+        raise ValueError(f"erode_width must be at least 1 pixel, not {erode_width}")
+
+
+def erosion_halo(erode_width=1):
+    # Context a chunk needs around its core for an exact result: a pixel is
+    # decided by the gaps within erode_width and the large gaps within
+    # erode_width + 1 of it
+    check_erode_width(erode_width)
+    return erode_width + 1
+
+
+def strip_extents(raster_height, chunk_height=1000, overlap_factor=0.1, min_halo=0):
+    # (start_row, end_row, buffer_start_row, buffer_end_row) of every strip.
+    # Consecutive chunks overlap by overlap_pixels; end_row stops where the
+    # next chunk starts, so every output row is written exactly once. The
+    # buffer read around each strip is at least min_halo rows, however small
+    # the overlap.
+    overlap_pixels = int(chunk_height * overlap_factor)
+    starts = list(range(0, raster_height, chunk_height - overlap_pixels))
+    halo = max(overlap_pixels, min_halo)
+    extents = []
+    for i, start_row in enumerate(starts):
+        end_row = min(start_row + chunk_height, raster_height)
+        if i + 1 < len(starts):
+            end_row = min(end_row, starts[i + 1])
+        extents.append((start_row, end_row, max(0, start_row - halo), min(raster_height, start_row + chunk_height + halo)))
+    return extents
+
+
+def round_up(value, multiple):
+    return -(-value // multiple) * multiple
+
+
+def plan_tile_shape(block_shape, raster_width, raster_height, tile_size):
+    # Round the requested tile size up to whole native blocks (GeoTIFF tiles or
+    # strips, HDF5 chunks). Full-width strip layouts are cut at tile_size
+    # columns, since a strip is decoded whole either way.
+    block_rows, block_cols = block_shape
+    tile_height = min(raster_height, round_up(tile_size, block_rows))
+    if block_cols >= raster_width:
+        tile_width = min(raster_width, tile_size)
+    else:
+        tile_width = min(raster_width, round_up(tile_size, block_cols))
+    return tile_height, tile_width
+
+
+def tile_extents(length, tile_length, halo, origin=0):
+    # (start, end, buffer_start, buffer_end) of every tile along one axis:
+    # non-overlapping tiles with a halo on both sides. origin shifts the grid
+    # so tile edges fall on block edges (BAG grids are stored south-up, so
+    # their block rows start at the bottom).
+    starts = sorted({0, *range(origin % tile_length, length, tile_length)})
+    return [(start, end, max(0, start - halo), min(length, end + halo))
+            for start, end in zip(starts, starts[1:] + [length])]